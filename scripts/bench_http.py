@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# End-to-end HTTP benchmark: boots the real venvui server against a
+# synthetic project/package tree, with stub systemctl, journalctl,
+# virtualenv and pip executables, and drives the API with concurrent
+# clients. Results are saved as JSON so runs can be compared:
+#
+#   python scripts/bench_http.py --projects 100 --concurrency 20
+#   python scripts/bench_http.py --compare bench-results/<previous>.json
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import aiohttp
+import toml
+
+repo_path = Path(__file__).absolute().parent.parent
+
+# Stubs read their behaviour from the environment:
+# STUB_LATENCY (seconds per call) and STUB_LINES (output lines)
+STUBS = {
+    'systemctl': """#!/bin/sh
+sleep "$STUB_LATENCY"
+while [ "${1#--}" != "$1" ]; do shift; done
+command=$1
+shift
+for unit in "$@"; do
+    case $command in
+        is-enabled) echo enabled ;;
+        is-active) echo active ;;
+    esac
+done
+""",
+    'journalctl': """#!/bin/sh
+sleep "$STUB_LATENCY"
+i=0
+while [ $i -lt "$STUB_LINES" ]; do
+    echo '{"__REALTIME_TIMESTAMP": "1500000000000000", "MESSAGE": "line '$i'",\
+ "SYSLOG_IDENTIFIER": "stub", "_TRANSPORT": "stdout"}'
+    i=$((i + 1))
+done
+""",
+    'virtualenv': """#!/bin/sh
+sleep "$STUB_LATENCY"
+for last; do :; done
+mkdir -p "$last/bin"
+cp "$(dirname "$0")/pip" "$last/bin/pip"
+echo "created virtual environment in $last"
+""",
+    'pip': """#!/bin/sh
+sleep "$STUB_LATENCY"
+echo "Processing $3"
+i=0
+while [ $i -lt "$STUB_LINES" ]; do
+    echo "  Downloading dependency-$i.whl (100 kB)"
+    i=$((i + 1))
+done
+echo "Installing collected packages: stub"
+echo "Successfully installed stub"
+""",
+}
+
+
+def make_stubs(bin_path):
+    bin_path.mkdir()
+    for name, script in STUBS.items():
+        stub = bin_path / name
+        stub.write_text(script)
+        stub.chmod(0o755)
+
+
+def make_wheel(path, name, version):
+    dist_info = '%s-%s.dist-info' % (name, version)
+    with zipfile.ZipFile(path, 'w') as wheel:
+        wheel.writestr(dist_info + '/METADATA',
+                       'Metadata-Version: 2.1\nName: %s\nVersion: %s\n'
+                       'Summary: Synthetic package\n' % (name, version))
+        wheel.writestr(dist_info + '/WHEEL',
+                       'Wheel-Version: 1.0\nRoot-Is-Purelib: true\n')
+        wheel.writestr(dist_info + '/RECORD', '')
+
+
+def make_tree(root, projects, services, packages):
+    project_path = root / 'projects'
+    package_path = root / 'data' / 'pkg'
+    for path in (project_path, package_path, root / 'data' / 'tmp',
+                 root / 'data' / 'logs'):
+        path.mkdir(parents=True)
+    for i in range(projects):
+        key = 'project%04d' % i
+        path = project_path / key
+        (path / 'venv').mkdir(parents=True)
+        config = {
+            'name': key,
+            'created_at': datetime.utcnow(),
+            'config_files': {
+                'unit': {'template': 'systemd-simple.j2',
+                         'path': '$PROJECT_PATH/%s.service' % key,
+                         'variables': {'description': '$PROJECT_NAME',
+                                       'execstart': '$PROJECT_PATH/run',
+                                       'workingdir': '$PROJECT_PATH'}}},
+            'services': ['%s-%d.service' % (key, j) for j in range(services)]
+        }
+        with open(path / 'project.toml', 'w') as f:
+            toml.dump(config, f)
+    for i in range(packages):
+        make_wheel(package_path / ('package%04d-1.0-py3-none-any.whl' % i),
+                   'package%04d' % i, '1.0')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_config(root, port, bin_path):
+    config = {
+        'http_host': '127.0.0.1',
+        'http_port': port,
+        'project_path': str(root / 'projects'),
+        'package_path': str(root / 'data' / 'pkg'),
+        'temp_path': str(root / 'data' / 'tmp'),
+        'logs_path': str(root / 'data' / 'logs'),
+        'python_path': sys.executable,
+        'virtualenv_path': str(bin_path / 'virtualenv'),
+        'debug_mode': False,
+        'logging': {
+            'version': 1,
+            'disable_existing_loggers': False,
+            'root': {'level': 'WARNING', 'handlers': ['console']},
+            'handlers': {'console': {'class': 'logging.StreamHandler'}},
+        }
+    }
+    config_file = root / 'venvui.toml'
+    with open(config_file, 'w') as f:
+        toml.dump(config, f)
+    return config_file
+
+
+def start_server(config_file, bin_path, latency, lines, workers=0):
+    env = dict(os.environ)
+    env['PATH'] = '%s:%s' % (bin_path, env['PATH'])
+    env['PYTHONPATH'] = '%s:%s' % (repo_path, env.get('PYTHONPATH', ''))
+    env['STUB_LATENCY'] = str(latency)
+    env['STUB_LINES'] = str(lines)
+    return subprocess.Popen(
+        [sys.executable, '-c', 'import venvui.app; venvui.app.main()',
+         '-c', str(config_file), '--workers', str(workers)], env=env)
+
+
+async def wait_ready(session, base_url, timeout=60):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            async with session.get(base_url + '/api/ready') as response:
+                if response.status == 200:
+                    return time.perf_counter() - started
+        except aiohttp.ClientConnectionError:
+            pass
+        await asyncio.sleep(0.01)
+    raise TimeoutError("Server not ready after %s s" % timeout)
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile
+    rank = max(math.ceil(q / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+async def drive(session, url, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': errors,
+            'rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000}
+
+
+async def deploy(session, base_url, projects):
+    # One deployment per project, all at once, until all of them finish
+    started = time.perf_counter()
+    keys = []
+    for key in projects:
+        async with session.post(
+                '%s/api/projects/%s/deployments' % (base_url, key),
+                json={'filename': 'package0000-1.0-py3-none-any.whl'}) as r:
+            keys.append((await r.json())['key'])
+    pending = set(keys)
+    while pending:
+        for key in list(pending):
+            async with session.get(
+                    '%s/api/deployments/%s' % (base_url, key)) as r:
+                if (await r.json())['state'] in ('done', 'failed'):
+                    pending.discard(key)
+        await asyncio.sleep(0.01)
+    return {'deployments': len(keys),
+            'elapsed_s': time.perf_counter() - started}
+
+
+async def benchmark(args, base_url):
+    project = 'project0000'
+    service = 'project0000-0.service'
+    endpoints = [
+        '/api/projects',
+        '/api/projects?fields=key,name',
+        '/api/projects/%s' % project,
+        '/api/projects/%s/configs' % project,
+        '/api/packages',
+        '/api/packages?fields=filename,size',
+        '/api/services',
+        '/api/services/%s' % service,
+        '/api/services/%s/log' % service,
+        '/api/deployments',
+        '/api/metrics',
+        '/',
+    ]
+    results = {}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        results['startup_s'] = await wait_ready(session, base_url)
+        results['endpoints'] = {}
+        for endpoint in endpoints:
+            result = await drive(session, base_url + endpoint,
+                                 args.concurrency, args.duration)
+            results['endpoints'][endpoint] = result
+            print('%-45s %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms  errors %d'
+                  % (endpoint, result['rps'], result['p50_ms'],
+                     result['p99_ms'], result['errors']))
+        if args.deployments:
+            projects = ['project%04d' % i for i in
+                        range(min(args.deployments, args.projects))]
+            results['deploy'] = await deploy(session, base_url, projects)
+            print('%d deployments: %.3f s' % (
+                results['deploy']['deployments'],
+                results['deploy']['elapsed_s']))
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=str(repo_path),
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(previous, current):
+    print('\nCompared with %s (%s):' % (previous['revision'],
+                                        previous['date']))
+    for endpoint, result in current['endpoints'].items():
+        before = previous['endpoints'].get(endpoint)
+        if not before:
+            continue
+        print('%-45s rps %+7.1f%%  p50 %+7.1f%%  p99 %+7.1f%%' % (
+            endpoint,
+            (result['rps'] / before['rps'] - 1) * 100,
+            (result['p50_ms'] / before['p50_ms'] - 1) * 100,
+            (result['p99_ms'] / before['p99_ms'] - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the venvui HTTP API end to end.')
+    parser.add_argument('--projects', type=int, default=50)
+    parser.add_argument('--services', type=int, default=2,
+                        help='Services per project')
+    parser.add_argument('--packages', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=3,
+                        help='Seconds per endpoint')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Latency of each stub command, in seconds')
+    parser.add_argument('--lines', type=int, default=50,
+                        help='Output lines of journalctl and pip stubs')
+    parser.add_argument('--deployments', type=int, default=5,
+                        help='Concurrent deployments to time (0 to skip)')
+    parser.add_argument('--output', default=str(repo_path / 'bench-results'),
+                        help='Directory where results are saved')
+    parser.add_argument('--compare', help='Previous results file')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='HTTP worker processes of the server')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        bin_path = root / 'bin'
+        make_stubs(bin_path)
+        make_tree(root, args.projects, args.services, args.packages)
+        port = free_port()
+        config_file = write_config(root, port, bin_path)
+        server = start_server(config_file, bin_path, args.latency,
+                              args.lines, args.workers)
+        try:
+            loop = asyncio.get_event_loop()
+            results = loop.run_until_complete(
+                benchmark(args, 'http://127.0.0.1:%d' % port))
+        finally:
+            server.terminate()
+            server.wait()
+
+    results['revision'] = git_revision()
+    results['date'] = datetime.utcnow().isoformat()
+    results['parameters'] = vars(args)
+    output = Path(args.output)
+    output.mkdir(exist_ok=True)
+    filename = output / ('%s-%s.json' % (
+        results['revision'], datetime.utcnow().strftime('%Y%m%d-%H%M%S')))
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nStartup (until /api/ready): %.3f s' % results['startup_s'])
+    print('Results saved to %s' % filename)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Measures how long ProjectService takes to become ready against a synthetic
+# tree of projects, using a stub systemctl with a configurable latency.
+#
+#   python scripts/bench_startup.py --projects 500 --services 2 --latency 0.02
+
+import argparse
+import asyncio
+import os
+import stat
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import toml
+
+from venvui.services import ProjectService, SystemdManager
+
+FAKE_SYSTEMCTL = """#!/bin/sh
+sleep {latency}
+# Skip --user --no-legend
+shift 2
+command=$1
+shift
+for unit in "$@"; do
+    case $command in
+        is-enabled) echo enabled ;;
+        is-active) echo active ;;
+    esac
+done
+"""
+
+
+def make_tree(root, projects, services):
+    for i in range(projects):
+        key = 'project%04d' % i
+        path = root / key
+        (path / 'venv').mkdir(parents=True)
+        config = {'name': key,
+                  'created_at': datetime.utcnow(),
+                  'config_files': {},
+                  'services': ['%s-%d.service' % (key, j)
+                               for j in range(services)]}
+        with open(path / 'project.toml', 'w') as f:
+            toml.dump(config, f)
+
+
+def make_systemctl(bin_path, latency):
+    systemctl = bin_path / 'systemctl'
+    systemctl.write_text(FAKE_SYSTEMCTL.format(latency=latency))
+    systemctl.chmod(systemctl.stat().st_mode | stat.S_IEXEC)
+
+
+async def measure(project_root):
+    started = time.time()
+    systemd_svc = SystemdManager(logview_svc=None)
+    project_svc = ProjectService(project_root=project_root,
+                                 deployment_svc=None, package_svc=None,
+                                 systemd_svc=systemd_svc, config_svc=None)
+    first_listed = None
+    while not project_svc.ready:
+        if first_listed is None and project_svc.list_projects():
+            first_listed = time.time() - started
+        await asyncio.sleep(0.001)
+    return first_listed, time.time() - started, project_svc
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark venvui project loading at startup.')
+    parser.add_argument('--projects', type=int, default=200)
+    parser.add_argument('--services', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Latency of each systemctl call, in seconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        project_root = tmp / 'projects'
+        bin_path = tmp / 'bin'
+        bin_path.mkdir()
+        make_tree(project_root, args.projects, args.services)
+        make_systemctl(bin_path, args.latency)
+        os.environ['PATH'] = '%s:%s' % (bin_path, os.environ['PATH'])
+
+        loop = asyncio.get_event_loop()
+        first, total, project_svc = loop.run_until_complete(
+            measure(project_root))
+
+    print('projects: %d, services per project: %d, systemctl latency: %s s'
+          % (args.projects, args.services, args.latency))
+    print('first project listed: %.3f s' % (first or total))
+    print('ready: %.3f s (%d projects loaded)' %
+          (total, len(project_svc.projects)))
+
+
+if __name__ == '__main__':
+    main()
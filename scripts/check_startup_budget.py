@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Startup budget check: fails (exit status 1) when importing venvui.app or
+# bringing the HTTP port up gets slower than the budget, or when one of the
+# modules that is meant to be imported on first use shows up at import time.
+#
+#   python scripts/check_startup_budget.py
+#   python scripts/check_startup_budget.py --import-budget 0.3 --first-200 1.5
+
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from bench_http import (free_port, make_stubs, make_tree, repo_path,
+                        start_server, write_config)
+
+# Imported by the code paths that need them, never by venvui.app
+DEFERRED_MODULES = ('jinja2', 'pkginfo', 'cProfile', 'pstats', 'tracemalloc',
+                    'aiohttp_cors')
+
+
+def import_times():
+    # module -> cumulative import time in seconds, from -X importtime
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import venvui.app'],
+        cwd=str(repo_path), stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def first_200(url, started, timeout=60):
+    while time.perf_counter() - started < timeout:
+        try:
+            with urllib.request.urlopen(url) as response:
+                if response.status == 200:
+                    return time.perf_counter() - started
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.005)
+    raise TimeoutError("No 200 from %s after %s s" % (url, timeout))
+
+
+def startup_times(projects):
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        bin_path = root / 'bin'
+        make_stubs(bin_path)
+        make_tree(root, projects, 2, 5)
+        port = free_port()
+        config_file = write_config(root, port, bin_path)
+        base_url = 'http://127.0.0.1:%d' % port
+        started = time.perf_counter()
+        server = start_server(config_file, bin_path, 0.005, 10)
+        try:
+            api = first_200(base_url + '/api/projects', started)
+            ready = first_200(base_url + '/api/ready', started)
+            frontend = first_200(base_url + '/', started)
+        finally:
+            server.terminate()
+            server.wait()
+    return api, ready, frontend
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check venvui import and startup times against a budget.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Runs per measurement, the best one is kept')
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--import-budget', type=float, default=0.4,
+                        help='Seconds to import venvui.app')
+    parser.add_argument('--first-200', type=float, default=2.0,
+                        help='Seconds from process start to the first 200 '
+                             'from the API')
+    args = parser.parse_args()
+
+    failures = []
+    runs = [import_times() for _ in range(args.runs)]
+    imported = min(times['venvui.app'] for times in runs)
+    print('import venvui.app: %.3f s (budget %.3f s)'
+          % (imported, args.import_budget))
+    if imported > args.import_budget:
+        failures.append('import venvui.app took %.3f s' % imported)
+    slowest = sorted(((name, cumulative) for name, cumulative in
+                      runs[0].items() if '.' not in name),
+                     key=lambda item: item[1], reverse=True)
+    for name, cumulative in slowest[:5]:
+        print('  %-30s %.3f s' % (name, cumulative))
+    eager = [name for name in DEFERRED_MODULES if name in runs[0]]
+    if eager:
+        failures.append('imported at startup: %s' % ', '.join(eager))
+
+    results = [startup_times(args.projects) for _ in range(args.runs)]
+    api, ready, frontend = (min(times) for times in zip(*results))
+    print('first 200 from /api/projects: %.3f s (budget %.3f s)'
+          % (api, args.first_200))
+    print('first 200 from /api/ready: %.3f s' % ready)
+    print('first 200 from /: %.3f s' % frontend)
+    if api > args.first_200:
+        failures.append('first 200 took %.3f s' % api)
+
+    for failure in failures:
+        print('FAILED: %s' % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
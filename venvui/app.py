@@ -8,8 +8,8 @@ from pathlib import Path
 import warnings
 from time import time
 
-import aiohttp_cors
-from aiohttp import web
+from aiohttp import hdrs, web
+from aiohttp.web import ContentCoding
 import toml
 
 from venvui import views
@@ -19,10 +19,31 @@ from venvui.services import PackageService
 from venvui.services import DeploymentService
 from venvui.services import SystemdManager
 from venvui.services import LogViewService
-from venvui.utils.misc import json_error
+from venvui.services import ResourceMonitor
+from venvui.services import ProjectWatcher
+from venvui.services import LoopMonitor
+from venvui.services import ProfilerService
+from venvui.services import InventoryService
+from venvui.services import VenvCollector
+from venvui.services import DedupService
+from venvui.utils.metrics import Counter, Gauge, Histogram
+from venvui.utils.misc import json_error, negotiate_encoding
+from venvui.utils.subproc import ExecutorSaturated, SubprocessExecutor
+from venvui.utils.static import StaticAssets
+from venvui.workers import SnapshotPublisher, WorkerManager
+from venvui.workers import SNAPSHOT_HEADER, remove_snapshot, supervisor_paths
 
 logger = logging.getLogger(__name__)
 
+REQUEST_DURATION = Histogram(
+    'venvui_http_request_duration_seconds',
+    'Time spent handling requests, by route', ['method', 'route'])
+REQUESTS_TOTAL = Counter(
+    'venvui_http_requests_total',
+    'Handled requests, by route and status', ['method', 'route', 'status'])
+REQUESTS_IN_FLIGHT = Gauge(
+    'venvui_http_requests_in_flight', 'Requests being handled')
+
 here_path = Path(__file__).parent
 
 def main(args=None):
@@ -31,62 +52,153 @@ def main(args=None):
     parser.add_argument('-c', '--config', required=True,
                         type=argparse.FileType('r'),
                         help='Configuration file')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='HTTP worker processes (0 to serve from this '
+                             'process)')
     args = parser.parse_args(args)
-    return app(config_file=args.config)
+    return app(config_file=args.config, workers=args.workers)
 
 
-def app(config_file):
+def app(config_file, workers=None):
+    # Workers load the configuration file again by themselves
+    config_path = getattr(config_file, 'name', config_file)
     config = load_config(config_file)
+    if workers is None:
+        workers = config.get('workers', 0)
 
     logging.config.dictConfig(config['logging'])
     logging.captureWarnings(True)
     logger.info('Logging configured!')
 
-    logview_svc = LogViewService()
-    configfile_svc = ConfigService()
+    loop_monitor = LoopMonitor(
+        threshold=config.get('loop_block_threshold', 0.25))
+    executor = SubprocessExecutor({
+        name: (pool.get('size', 4), pool.get('queue_size', 100),
+               pool.get('timeout'))
+        for name, pool in config.get('subprocesses', {}).items()})
+    logview_svc = LogViewService(executor=executor)
+    configfile_svc = ConfigService(
+        bytecode_cache_path=config.get('template_cache_path'))
     package_svc = PackageService(package_root=config['package_path'],
                                  temp_path=config['temp_path'])
-    deploy_svc = DeploymentService(temp_path=config['temp_path'],
-                                   logs_path=config['logs_path'])
-    systemd_svc = SystemdManager(logview_svc=logview_svc)
+    dedup = config.get('dedup', {})
+    dedup_svc = None
+    if dedup.get('enabled', False):
+        dedup_svc = DedupService(
+            index_path=dedup.get('index_path', 'dedup.sqlite'),
+            min_size=dedup.get('min_size', 1024))
+    deploy_svc = DeploymentService(
+        temp_path=config['temp_path'], logs_path=config['logs_path'],
+        python_path=config.get('python_path', '/usr/bin/python3.6'),
+        virtualenv_path=config.get('virtualenv_path', '/usr/bin/virtualenv'),
+        dedup_svc=dedup_svc,
+        precompile=config.get('precompile', False),
+        precompile_workers=config.get('precompile_workers', 0),
+        precompile_invalidation_mode=config.get(
+            'precompile_invalidation_mode'),
+        executor=executor)
+    inventory_svc = InventoryService()
+    resource_svc = ResourceMonitor(
+        cgroup_root=config.get('cgroup_root', '/sys/fs/cgroup'),
+        interval=config.get('resources_interval', 5))
+    systemd_svc = SystemdManager(logview_svc=logview_svc,
+                                 resource_svc=resource_svc,
+                                 executor=executor)
     project_svc = ProjectService(project_root=config['project_path'],
                                  deployment_svc=deploy_svc,
                                  package_svc=package_svc,
                                  systemd_svc=systemd_svc,
-                                 config_svc=configfile_svc)
+                                 config_svc=configfile_svc,
+                                 executor=executor)
+    retention = config.get('retention', {})
+    collector = VenvCollector(
+        project_svc=project_svc, inventory_svc=inventory_svc,
+        dedup_svc=dedup_svc,
+        keep_last=retention.get('keep_last', 3),
+        keep_days=retention.get('keep_days', 7),
+        interval=retention.get('interval', 3600),
+        delete_rate=retention.get('delete_rate', 2000),
+        delete_rate_deploying=retention.get('delete_rate_deploying', 200),
+        enabled=retention.get('enabled', False))
+    watcher_svc = ProjectWatcher(project_svc=project_svc,
+                                 interval=config.get('watch_interval', 5))
+
+    middlewares = [metrics_middleware, compression_middleware,
+                   error_middleware]
+    if workers:
+        socket_path, snapshot_path = supervisor_paths(config)
+        publisher = SnapshotPublisher(
+            project_svc=project_svc, systemd_svc=systemd_svc,
+            deployment_svc=deploy_svc, package_svc=package_svc,
+            socket_path=socket_path, snapshot_path=snapshot_path,
+            interval=config.get('snapshot_interval', 0.5),
+            refresh_timeout=config.get('snapshot_refresh_timeout', 5))
+        middlewares.append(publisher.middleware)
 
-    subapp = web.Application(middlewares=[timer_middleware, error_middleware],
+    subapp = web.Application(middlewares=middlewares,
                              debug=config['debug_mode'],
                              logger=logging.getLogger('venvui.access'))
 
     subapp['config'] = config
+    subapp['executor'] = executor
     subapp['configfile'] = configfile_svc
     subapp['logview'] = logview_svc
     subapp['projects'] = project_svc
     subapp['packages'] = package_svc
     subapp['deployments'] = deploy_svc
     subapp['systemd'] = systemd_svc
+    subapp.on_shutdown.append(flush_projects)
+    subapp['resources'] = resource_svc
+    subapp['watcher'] = watcher_svc
+    subapp['loop_monitor'] = loop_monitor
+    subapp['inventory'] = inventory_svc
+    subapp['collector'] = collector
+    if dedup_svc:
+        subapp['dedup'] = dedup_svc
+    if config.get('profiling_enabled', False):
+        subapp['profiler'] = ProfilerService()
 
+    # Only the process serving the API needs it, HTTP workers don't
+    import aiohttp_cors
     cors = aiohttp_cors.setup(subapp, defaults={
         "*": aiohttp_cors.ResourceOptions(allow_credentials=True,
                                           allow_headers='*',
                                           allow_methods='*'),
     })
 
-    static = here_path / 'frontend'
+    frontend = StaticAssets(here_path / 'frontend')
 
     setup_routes(subapp, cors)
 
     app = web.Application()
     app.add_subapp('/api', subapp)
 
-    async def index(request):
-        return web.FileResponse(static / 'index.html')
+    app.on_startup.append(frontend.preload)
+    app.router.add_get('/', frontend.handle)
+    app.router.add_get('/{path:.+}', frontend.handle)
+
+    if workers:
+        # The workers own the HTTP port, this process only the socket
+        manager = WorkerManager(config_path, workers)
+        app.on_startup.append(manager.start)
+        app.on_shutdown.append(manager.stop)
+        if socket_path.is_socket():
+            socket_path.unlink()
+        # A previous run's snapshot must not be served, workers forward
+        # reads until the first one is published
+        remove_snapshot(snapshot_path)
+        web.run_app(app, path=str(socket_path),
+                    loop=asyncio.get_event_loop())
+        return
 
-    app.router.add_get('/', index)
-    app.router.add_static('/', static)
+    # Services scheduled their tasks on the current loop, run_app must use it
+    web.run_app(app, host=config['http_host'], port=config['http_port'],
+                loop=asyncio.get_event_loop())
 
-    web.run_app(app, host=config['http_host'], port=config['http_port'])
+
+async def flush_projects(app):
+    # Pending project.toml writes must not be lost on shutdown
+    await app['projects'].flush()
 
 
 def setup_routes(app, cors, prefix=''):
@@ -102,6 +214,12 @@ def setup_routes(app, cors, prefix=''):
         if delete:
             resource.add_route('DELETE', delete)
 
+    route('/ready',
+          get=views.get_readiness)
+    route('/metrics',
+          get=views.get_metrics)
+    route('/batch',
+          post=views.batch)
     route('/projects',
           get=views.list_projects,
           post=views.create_project)
@@ -110,6 +228,26 @@ def setup_routes(app, cors, prefix=''):
     route('/projects/{key}/deployments',
           get=views.list_project_deployments,
           post=views.start_deployment)
+    route('/projects/{key}/deployments/stats',
+          get=views.get_project_deployment_stats)
+    route('/projects/{key}/venvs',
+          get=views.list_project_venvs)
+    route('/projects/{key}/rollback',
+          post=views.rollback_project)
+    route('/projects/{key}/venvs/gc',
+          post=views.collect_project_venvs)
+    route('/projects/{key}/retention',
+          get=views.get_retention,
+          put=views.set_retention)
+    route('/venvs/usage',
+          get=views.get_venvs_usage)
+    route('/projects/{key}/venvs/{venv}/packages',
+          get=views.get_venv_packages)
+    route('/projects/{key}/venvs/{venv}/diff/{other}',
+          get=views.get_venv_diff)
+    if 'dedup' in app:
+        route('/projects/{key}/venvs/{venv}/dedup',
+              post=views.dedup_venv)
     route('/projects/{key}/configs',
           get=views.get_config_files,
           post=views.add_config_file)
@@ -119,6 +257,8 @@ def setup_routes(app, cors, prefix=''):
           delete=views.remove_config_file)
     route('/projects/{key}/configs/{config}/install',
           post=views.install_config_file)
+    route('/configs/install',
+          post=views.install_config_files)
     route('/projects/{key}/services',
           get=views.get_project_services,
           post=views.add_service)
@@ -134,25 +274,63 @@ def setup_routes(app, cors, prefix=''):
           get=views.get_package)
     route('/deployments',
           get=views.list_deployments)
+    route('/deployments/stats',
+          get=views.get_deployment_stats)
     route('/deployments/{key}',
           get=views.get_deployment)
     route('/deployments/{key}/log',
           get=views.get_deployment_log)
+    route('/deployments/{key}/packages',
+          get=views.get_deployment_packages)
     route('/services',
           get=views.list_services)
     route('/services/{service}',
           get=views.get_service)
     route('/services/{service}/log',
           get=views.get_service_log)
+    route('/services/{service}/resources',
+          get=views.get_service_resources)
+    route('/admin/loop',
+          get=views.get_loop_report)
+    # Profiling is only reachable when enabled in the configuration
+    if 'profiler' in app:
+        route('/admin/profile/cpu',
+              get=views.profile_cpu)
+        route('/admin/profile/memory',
+              get=views.profile_memory)
     #route('/services/{service}/{command}',
     #      post=views.service_execute_command)
 
 
+def route_label(request):
+    # Route patterns, not paths, to keep label cardinality bounded
+    route = request.match_info.route
+    resource = route.resource if route else None
+    return resource.canonical if resource else 'unmatched'
+
+
 @web.middleware
-async def timer_middleware(request, handler):
+async def metrics_middleware(request, handler):
+    if SNAPSHOT_HEADER in request.headers:
+        # Snapshot publishing, not client traffic
+        return await handler(request)
     now = time()
-    response = await handler(request)
-    elapsed = (time() - now) * 1000
+    status = 500
+    REQUESTS_IN_FLIGHT.inc()
+    try:
+        response = await handler(request)
+        if response:
+            status = response.status
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        elapsed = time() - now
+        route = route_label(request)
+        REQUEST_DURATION.labels(request.method, route).observe(elapsed)
+        REQUESTS_TOTAL.labels(request.method, route, status).inc()
+    elapsed *= 1000
     timer_logger = logger.getChild('timer')
     timer_logger.log(logging.DEBUG if elapsed <= 100 else logging.WARNING,
                      "%s: %.3f ms", request.rel_url, elapsed)
@@ -161,6 +339,24 @@ async def timer_middleware(request, handler):
     return response
 
 
+@web.middleware
+async def compression_middleware(request, handler):
+    response = await handler(request)
+    # Streamed responses (ndjson) compress themselves as they go
+    if not isinstance(response, web.Response) or response.prepared or \
+            response.body is None or \
+            hdrs.CONTENT_ENCODING in response.headers:
+        return response
+    min_size = request.app['config'].get('compression_min_size', 1024)
+    if len(response.body) < min_size:
+        return response
+    coding = negotiate_encoding(request)
+    if coding:
+        response.enable_compression(ContentCoding(coding))
+        response.headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+    return response
+
+
 @web.middleware
 async def error_middleware(request, handler):
     try:
@@ -174,6 +370,10 @@ async def error_middleware(request, handler):
         raise
     except asyncio.CancelledError:
         raise
+    except ExecutorSaturated as e:
+        response = json_error(str(e), 503)
+        response.headers[hdrs.RETRY_AFTER] = str(e.retry_after)
+        return response
     except Exception as e:
         logger.exception("Exception while handling request %s:",
                          request.rel_url)
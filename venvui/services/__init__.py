@@ -5,4 +5,11 @@ from .project import ProjectService
 from .package import PackageService
 from .deploy import DeploymentService
 from .systemd import SystemdManager
-from .logview import LogViewService
\ No newline at end of file
+from .logview import LogViewService
+from .resources import ResourceMonitor
+from .watcher import ProjectWatcher
+from .watchdog import LoopMonitor
+from .profiler import ProfilerService
+from .inventory import InventoryService
+from .retention import VenvCollector
+from .dedup import DedupService
@@ -1,15 +1,57 @@
 # -*- coding: utf-8 -*-
 
-import jinja2
+import difflib
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def digest(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def variables_digest(variables):
+    return digest(json.dumps(variables, sort_keys=True, default=str))
 
 
 class ConfigService:
 
-    def __init__(self):
-        self.jinja_env = jinja2.Environment(
-            loader=jinja2.PackageLoader('venvui', 'templates'),
-            undefined=jinja2.StrictUndefined
-        )
+    def __init__(self, bytecode_cache_path=None, render_cache_size=256):
+        self.bytecode_cache_path = bytecode_cache_path
+        # Importing jinja2 and building the environment is deferred to the
+        # first render, it is not needed to bring the HTTP port up
+        self._jinja_env = None
+        # template name -> (template, source digest)
+        self.template_digests = {}
+        # (template digest, variables digest) -> rendered
+        self.render_cache = OrderedDict()
+        self.render_cache_size = render_cache_size
+        # Rendering may happen in worker threads (bulk installs)
+        self.lock = threading.Lock()
+
+    @property
+    def jinja_env(self):
+        with self.lock:
+            if self._jinja_env is None:
+                import jinja2
+                # Compiled templates survive restarts in the bytecode cache
+                # (defaults to a directory under the system temp dir)
+                bytecode_cache = (
+                    jinja2.FileSystemBytecodeCache(self.bytecode_cache_path)
+                    if self.bytecode_cache_path
+                    else jinja2.FileSystemBytecodeCache())
+                self._jinja_env = jinja2.Environment(
+                    loader=jinja2.PackageLoader('venvui', 'templates'),
+                    undefined=jinja2.StrictUndefined,
+                    bytecode_cache=bytecode_cache
+                )
+            return self._jinja_env
 
     def list_templates(self):
         return self.jinja_env.list_templates('j2')
@@ -19,12 +61,66 @@ class ConfigService:
         with open(template.filename) as f:
             return f.read()
 
-    def generate(self, template_name, variables):
+    def _get_template(self, template_name):
         template = self.jinja_env.get_template(template_name)
-        return template.render(variables)
+        with self.lock:
+            cached = self.template_digests.get(template_name)
+        # The environment hands out a new template object when it reloads a
+        # changed file, so the digest only has to be computed then
+        if cached is None or cached[0] is not template:
+            source, _, _ = self.jinja_env.loader.get_source(self.jinja_env,
+                                                            template_name)
+            cached = (template, digest(source))
+            with self.lock:
+                self.template_digests[template_name] = cached
+        return cached
+
+    def generate(self, template_name, variables):
+        template, template_digest = self._get_template(template_name)
+        key = (template_digest, variables_digest(variables))
+        with self.lock:
+            rendered = self.render_cache.get(key)
+            if rendered is not None:
+                self.render_cache.move_to_end(key)
+                return rendered
+        rendered = template.render(variables)
+        with self.lock:
+            self.render_cache[key] = rendered
+            if len(self.render_cache) > self.render_cache_size:
+                self.render_cache.popitem(last=False)
+        return rendered
+
+    @staticmethod
+    def _read_existing(full_path):
+        try:
+            with open(full_path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def diff_file(self, template_name, full_path, variables):
+        rendered = self.generate(template_name, variables)
+        existing = self._read_existing(full_path)
+        if existing is None:
+            existing = ''
+            from_file = '/dev/null'
+        else:
+            existing = existing.decode('utf-8', 'replace')
+            from_file = str(full_path)
+        diff = ''.join(difflib.unified_diff(
+            existing.splitlines(keepends=True),
+            rendered.splitlines(keepends=True),
+            fromfile=from_file, tofile=str(full_path)))
+        return rendered, diff
 
     def install_file(self, template_name, full_path, variables):
         rendered = self.generate(template_name, variables)
+        data = rendered.encode('utf-8')
+        existing = self._read_existing(full_path)
+        if existing is not None and len(existing) == len(data) and \
+                digest(existing) == digest(data):
+            logger.debug("'%s' is unchanged, not writing", full_path)
+            return rendered, False
         with open(full_path, 'w') as f:
             f.write(rendered)
-        return rendered
+        return rendered, True
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+from venvui.utils.metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+DEDUP_BYTES_SAVED = Counter(
+    'venvui_dedup_bytes_saved_total',
+    'Bytes saved by hardlinking duplicate venv files')
+DEDUP_FILES_LINKED = Counter(
+    'venvui_dedup_files_linked_total',
+    'Venv files replaced by a hardlink to an identical file')
+DEDUP_DURATION = Histogram(
+    'venvui_dedup_duration_seconds', 'Time spent deduplicating a venv',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+# Files that pip or the application may rewrite in place, or that are
+# specific to one venv
+EXCLUDED_NAMES = {'RECORD', 'INSTALLER', 'REQUESTED', 'direct_url.json',
+                  'pyvenv.cfg'}
+EXCLUDED_SUFFIXES = ('.pth', '.lock', '.log', '.db', '.sqlite', '.sqlite3')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (digest, size, device)
+)
+"""
+
+
+def file_digest(path, chunk_size=1 << 16):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def candidates(root, min_size):
+    # Regular files that are not linked yet and not excluded, with their
+    # stat result; paths are absolute since the index outlives the process
+    for dirpath, dirnames, filenames in os.walk(os.path.abspath(str(root))):
+        for name in filenames:
+            if name in EXCLUDED_NAMES or name.endswith(EXCLUDED_SUFFIXES):
+                continue
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or st.st_nlink > 1 or \
+                    st.st_size < min_size:
+                continue
+            yield path, st
+
+
+class DedupService:
+
+    def __init__(self, index_path, min_size=1024):
+        self.index_path = str(index_path)
+        # Smaller files don't save enough to be worth an index entry
+        self.min_size = min_size
+        # One venv at a time: runs are disk bound and share the index
+        self.lock = threading.Lock()
+        self.db = None
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.index_path,
+                                      check_same_thread=False)
+            self.db.execute(SCHEMA)
+        return self.db
+
+    def _canonical(self, db, digest, st):
+        row = db.execute(
+            'SELECT path, inode, mtime_ns FROM files '
+            'WHERE digest = ? AND size = ? AND device = ?',
+            (digest, st.st_size, st.st_dev)).fetchone()
+        if row is None:
+            return None
+        path, inode, mtime_ns = row
+        try:
+            canonical = os.lstat(path)
+        except FileNotFoundError:
+            return None
+        # A canonical copy that was replaced or modified can't be trusted
+        if canonical.st_ino != inode or canonical.st_mtime_ns != mtime_ns \
+                or canonical.st_size != st.st_size:
+            return None
+        if canonical.st_mode != st.st_mode or canonical.st_uid != st.st_uid:
+            return None
+        return path
+
+    @staticmethod
+    def _link(canonical, path):
+        # Replaced atomically: the file is never missing
+        temp = '%s.dedup-%d' % (path, os.getpid())
+        os.link(canonical, temp)
+        try:
+            os.replace(temp, path)
+        except OSError:
+            os.unlink(temp)
+            raise
+
+    def _dedup(self, venv_path):
+        started = time.monotonic()
+        stats = {'files': 0, 'linked': 0, 'bytes_saved': 0}
+        with self.lock:
+            db = self._connect()
+            with db:
+                for path, st in candidates(venv_path, self.min_size):
+                    stats['files'] += 1
+                    try:
+                        digest = file_digest(path)
+                        canonical = self._canonical(db, digest, st)
+                        if canonical and canonical != path:
+                            try:
+                                self._link(canonical, path)
+                            except FileNotFoundError:
+                                # Deleted since it was checked, this file
+                                # takes its place
+                                pass
+                            else:
+                                stats['linked'] += 1
+                                stats['bytes_saved'] += st.st_blocks * 512
+                                continue
+                    except OSError:
+                        logger.warning("Cannot deduplicate '%s'", path,
+                                       exc_info=True)
+                        continue
+                    # First copy seen (or a stale entry): this file becomes
+                    # the canonical one
+                    db.execute(
+                        'INSERT OR REPLACE INTO files '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (digest, st.st_size, path, st.st_dev, st.st_ino,
+                         st.st_mtime_ns))
+        stats['elapsed'] = time.monotonic() - started
+        DEDUP_FILES_LINKED.inc(stats['linked'])
+        DEDUP_BYTES_SAVED.inc(stats['bytes_saved'])
+        DEDUP_DURATION.observe(stats['elapsed'])
+        logger.info("Deduplicated '%s': %d of %d files linked, %d bytes "
+                    "saved in %.3f s", venv_path, stats['linked'],
+                    stats['files'], stats['bytes_saved'], stats['elapsed'])
+        return stats
+
+    def _forget(self, venv_path):
+        # Paths under venv_path: '0' sorts right after '/'
+        prefix = os.path.abspath(str(venv_path))
+        with self.lock:
+            db = self._connect()
+            with db:
+                count = db.execute(
+                    'DELETE FROM files WHERE path >= ? AND path < ?',
+                    (prefix + '/', prefix + '0')).rowcount
+        logger.debug("Forgot %d files of '%s'", count, venv_path)
+        return count
+
+    async def forget(self, venv_path):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._forget, venv_path)
+
+    async def dedup(self, venv_path):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._dedup, venv_path)
@@ -3,21 +3,62 @@
 import asyncio
 import datetime
 import logging
+import math
 import os
 import time
 from pathlib import Path
 
+from venvui.utils.metrics import Counter, Gauge, Histogram
 from venvui.utils.misc import keygen, json_dumps
 from venvui.utils.streamlog import StreamLog
 from venvui.utils.subproc import SubProcessController
 
 logger = logging.getLogger(__name__)
 
+DEPLOYMENTS_ACTIVE = Gauge(
+    'venvui_deployments_active', 'Deployments not finished yet, by state',
+    ['state'])
+DEPLOYMENTS_TOTAL = Counter(
+    'venvui_deployments_total', 'Finished deployments, by state', ['state'])
+DEPLOYMENT_DURATION = Histogram(
+    'venvui_deployment_duration_seconds', 'Deployment run time, by state',
+    ['state'], buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200,
+                        1800, 3600))
+
+# Prefixes of pip output lines that mark the start of a phase
+PIP_PHASES = (
+    ('Looking in', 'pip_resolve'),
+    ('Processing ', 'pip_resolve'),
+    ('Collecting ', 'pip_resolve'),
+    ('Requirement already satisfied', 'pip_resolve'),
+    ('Downloading ', 'pip_download'),
+    ('Using cached ', 'pip_download'),
+    ('Building wheel', 'pip_build'),
+    ('Running setup.py', 'pip_build'),
+    ('Installing build dependencies', 'pip_build'),
+    ('Installing collected packages', 'pip_install_files'),
+    ('Successfully installed', 'pip_finish'),
+)
+
+
+def pip_phase(line):
+    line = line.lstrip()
+    for prefix, phase in PIP_PHASES:
+        if line.startswith(prefix):
+            return phase
+    return None
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile
+    rank = max(math.ceil(q / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
 
 class Deployment:
 
     def __init__(self, svc, key, project_key, venv_root, venv_name, pkg,
-                 callback=None):
+                 callback=None, admission=None):
         self.svc = svc
         self.key = key
         self.project_key = project_key
@@ -25,6 +66,8 @@ class Deployment:
         self.venv_name = venv_name
         self.pkg = pkg
         self.callback = callback
+        # Admission to the build pool, given back when it finishes
+        self.admission = admission
 
         self.venv_path = venv_root / venv_name
         self.stream_log = StreamLog()
@@ -35,6 +78,11 @@ class Deployment:
         self.started_at = None
         self.stopped_at = None
 
+        # Timing spans: finished ones and the ones still open, by name
+        self.spans = []
+        self.open_spans = {}
+        self.pip_phase = None
+
         self.stream_log.put(event='new_deployment',
                             key=self.key,
                             project_key=self.project_key,
@@ -42,16 +90,66 @@ class Deployment:
                             package_filename=self.pkg['filename'],
                             state=self.state)
 
-        self.sub = SubProcessController(self.stdout_writer, self.stderr_writer)
+        self.sub = SubProcessController(self.stdout_writer, self.stderr_writer,
+                                        chunked=True, pool=admission)
         logger.info("Deployment '%s' is: %s", self.key, self.state)
 
-    def stdout_writer(self, line):
-        line = line.decode('utf-8', 'ignore')
-        self.stream_log.put(event='command_output', channel='out', line=line)
+    def stdout_writer(self, lines):
+        records = []
+        tracking = 'pip_install' in self.open_spans
+        for line in lines:
+            line = line.decode('utf-8', 'ignore')
+            if tracking:
+                phase = pip_phase(line)
+                if phase and phase != self.pip_phase:
+                    # Output so far belongs to the previous phase
+                    self.stream_log.put_many(records)
+                    records = []
+                    self._switch_pip_phase(phase)
+            records.append({'event': 'command_output', 'channel': 'out',
+                            'line': line})
+        self.stream_log.put_many(records)
+
+    def stderr_writer(self, lines):
+        self.stream_log.put_many([
+            {'event': 'command_output', 'channel': 'err',
+             'line': line.decode('utf-8', 'ignore')} for line in lines])
+
+    def _set_state(self, state):
+        self.state = state
+        self.svc.touch()
+        self.stream_log.put(event='state_changed', state=self.state)
+        logger.info("Deployment '%s' is: %s", self.key, self.state)
+
+    def _start_span(self, name, parent=None):
+        self.open_spans[name] = (parent, time.time())
+        self.stream_log.put(event='phase_started', phase=name, parent=parent)
+
+    def _end_span(self, name):
+        parent, started = self.open_spans.pop(name)
+        elapsed = time.time() - started
+        self.spans.append((name, parent, elapsed))
+        self.svc.touch()
+        self.stream_log.put(event='phase_finished', phase=name,
+                            parent=parent, elapsed=elapsed)
 
-    def stderr_writer(self, line):
-        line = line.decode('utf-8', 'ignore')
-        self.stream_log.put(event='command_output', channel='err', line=line)
+    def _switch_pip_phase(self, phase):
+        if self.pip_phase:
+            self._end_span(self.pip_phase)
+        self.pip_phase = phase
+        if phase:
+            self._start_span(phase, parent='pip_install')
+
+    def phases(self):
+        # Total time per phase, in order of first appearance
+        totals = {}
+        for name, parent, elapsed in self.spans:
+            if name not in totals:
+                totals[name] = {'name': name, 'parent': parent,
+                                'elapsed': 0, 'count': 0}
+            totals[name]['elapsed'] += elapsed
+            totals[name]['count'] += 1
+        return list(totals.values())
 
     def partial_log(self):
         return self.stream_log.retrieve_partial()
@@ -60,19 +158,57 @@ class Deployment:
         return self.stream_log.retrieve()
 
     async def _run(self):
-        self.state = 'running'
         self.started_at = datetime.datetime.utcnow()
-        self.stream_log.put(event='state_changed', state=self.state)
-        logger.info("Deployment '%s' is: %s", self.key, self.state)
-        python_path = '/usr/bin/python3.6'
-        create_venv_command = ['/usr/bin/virtualenv', '-p' + python_path]
+        self._set_state('running')
+        create_venv_command = [self.svc.virtualenv_path,
+                               '-p' + self.svc.python_path]
         pip_path = self.venv_path / 'bin' / 'pip'
         #await self._execute('ping -c10 127.0.0.1', shell=True)
+        self._start_span('create_venv')
         await self._execute(*create_venv_command, str(self.venv_path))
+        self._end_span('create_venv')
+        self._start_span('pip_install')
+        self._switch_pip_phase('pip_startup')
         ret = await self._execute(str(pip_path), 'install', self.pkg['path'])
+        self._switch_pip_phase(None)
+        self._end_span('pip_install')
+        if ret == 0 and self.svc.precompile:
+            await self._precompile()
+        if ret == 0 and self.svc.dedup_svc:
+            await self._dedup()
         #await self._execute('ping -c1000 127.0.0.1', shell=True)
         return ret == 0
 
+    async def _precompile(self):
+        # Services then start with their bytecode in place instead of
+        # racing to write it; compileall -j uses a process pool
+        self._start_span('precompile')
+        command = [str(self.venv_path / 'bin' / 'python'), '-m', 'compileall',
+                   '-q', '-j', str(self.svc.precompile_workers)]
+        if self.svc.precompile_invalidation_mode:
+            command += ['--invalidation-mode',
+                        self.svc.precompile_invalidation_mode]
+        site_packages = sorted(
+            self.venv_path.glob('lib/python*/site-packages'))
+        # Some packages ship files for other Python versions that don't
+        # compile, that is not a reason to fail the deployment
+        await self._execute(*command, *(str(path) for path in site_packages))
+        self._end_span('precompile')
+
+    async def _dedup(self):
+        # Failing to share files only costs disk space, never the deployment
+        self._start_span('dedup')
+        try:
+            stats = await self.svc.dedup_svc.dedup(self.venv_path)
+        except Exception as e:
+            logger.exception("Deployment '%s': deduplication failed",
+                             self.key)
+            self.stream_log.put(event='dedup_failed',
+                                error='%s: %s' % (e.__class__.__name__, e))
+        else:
+            self.stream_log.put(event='dedup_finished', **stats)
+        self._end_span('dedup')
+
     def start(self):
         future = asyncio.ensure_future(self._run())
         future.add_done_callback(self._done)
@@ -84,12 +220,24 @@ class Deployment:
         logfile.add_done_callback(lambda f: f.result())
 
     def _done(self, future):
-        success = future.result()
-        self.state = 'done' if success else 'failed'
+        try:
+            success = future.result()
+        except (Exception, asyncio.CancelledError) as e:
+            # Still a finished deployment: its log is closed and the
+            # project is told
+            logger.exception("Deployment '%s' crashed", self.key)
+            self.stream_log.put(event='deployment_error',
+                                error='%s: %s' % (e.__class__.__name__, e))
+            success = False
+        if self.admission:
+            self.admission.close()
         self.stopped_at = datetime.datetime.utcnow()
-        self.stream_log.put(event='state_changed', state=self.state)
+        self._set_state('done' if success else 'failed')
+        DEPLOYMENTS_TOTAL.labels(self.state).inc()
+        DEPLOYMENT_DURATION.labels(self.state).observe(
+            (self.stopped_at - (self.started_at or self.created_at))
+            .total_seconds())
         self.stream_log.close()
-        logger.info("Deployment '%s' is: %s", self.key, self.state)
         if self.callback:
             self.callback(self)
 
@@ -124,30 +272,106 @@ class Deployment:
             'state': self.state,
             'created_at': self.created_at,
             'started_at': self.started_at,
-            'stopped_at': self.stopped_at
+            'stopped_at': self.stopped_at,
+            'elapsed': self.elapsed(),
+            'phases': self.phases()
         }
 
+    def elapsed(self):
+        if not self.started_at:
+            return None
+        stopped_at = self.stopped_at or datetime.datetime.utcnow()
+        return (stopped_at - self.started_at).total_seconds()
+
 
 class DeploymentService:
 
-    def __init__(self, temp_path, logs_path):
+    def __init__(self, temp_path, logs_path,
+                 python_path='/usr/bin/python3.6',
+                 virtualenv_path='/usr/bin/virtualenv', dedup_svc=None,
+                 precompile=False, precompile_workers=0,
+                 precompile_invalidation_mode=None, executor=None):
         self.deployments = {}
+        # Bumped on every change of the deployments, for ETags
+        self.version = 0
         self.temp_path = Path(temp_path)
         self.logs_path = Path(logs_path)
+        self.python_path = python_path
+        self.virtualenv_path = virtualenv_path
+        self.dedup_svc = dedup_svc
+        self.pool = executor['build'] if executor else None
+        self.precompile = precompile
+        # Worker processes for bytecode compilation, 0 for one per CPU
+        self.precompile_workers = precompile_workers
+        self.precompile_invalidation_mode = precompile_invalidation_mode
+        for state in ('pending', 'running'):
+            DEPLOYMENTS_ACTIVE.labels(state).set_function(
+                lambda state=state: self.count_deployments(state))
+
+    def count_deployments(self, state):
+        return sum(1 for deployment in self.deployments.values()
+                   if deployment.state == state)
 
     def deploy(self, project_key, venv_root, venv_name, package,
                callback=None):
+        # Refused here or never: an admitted deployment waits for its
+        # subprocesses instead of failing halfway
+        admission = self.pool.admit() if self.pool else None
         key = '%s-%s' % (project_key, venv_name)
         self.deployments[key] = Deployment(self, key, project_key, venv_root,
-                                           venv_name, package, callback)
+                                           venv_name, package, callback,
+                                           admission)
         self.deployments[key].start()
+        self.touch()
         return self.deployments[key]
 
+    def touch(self):
+        self.version += 1
+
     def list_deployments(self, by_project_key=None):
         if by_project_key:
             return [deployment for deployment in self.deployments.values()
                     if deployment.project_key == by_project_key]
         return list(self.deployments.values())
 
+    def running(self, by_project_key=None):
+        # Their elapsed time changes on every read, whatever the version
+        return any(deployment.started_at and not deployment.stopped_at
+                   for deployment in self.list_deployments(by_project_key))
+
     def get_deployment(self, key):
         return self.deployments[key]
+
+    def phase_stats(self, by_project_key=None, last=20):
+        # Percentiles of each phase over the last successful deployments
+        finished = {}
+        for deployment in sorted(self.deployments.values(),
+                                 key=lambda d: d.created_at):
+            if deployment.state != 'done':
+                continue
+            if by_project_key and deployment.project_key != by_project_key:
+                continue
+            finished.setdefault(deployment.project_key, []).append(deployment)
+        stats = {}
+        for project_key, deployments in finished.items():
+            samples = {}
+            for deployment in deployments[-last:]:
+                samples.setdefault('total', []).append(deployment.elapsed())
+                for phase in deployment.phases():
+                    samples.setdefault(phase['name'], []).append(
+                        phase['elapsed'])
+            stats[project_key] = {
+                'deployments': len(deployments[-last:]),
+                'phases': {name: self._summarize(values)
+                           for name, values in samples.items()}
+            }
+        return stats
+
+    @staticmethod
+    def _summarize(values):
+        values = sorted(values)
+        return {'count': len(values),
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': values[-1]}
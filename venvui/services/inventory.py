@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import re
+from collections import namedtuple
+from email.parser import HeaderParser
+
+logger = logging.getLogger(__name__)
+
+Distribution = namedtuple('Distribution', ['name', 'version', 'summary',
+                                           'requires', 'installer',
+                                           'files', 'size'])
+
+
+def canonical_name(name):
+    # PEP 503 normalization, so 'Foo_Bar' and 'foo-bar' compare equal
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def read_headers(path):
+    # Only the header block is needed, the long description is skipped
+    lines = []
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.strip():
+                break
+            lines.append(line)
+    return HeaderParser().parsestr(''.join(lines))
+
+
+def read_record(path):
+    # RECORD is a CSV of path,hash,size; the size is empty for some files
+    files = size = 0
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                files += 1
+                _, _, line_size = line.rstrip().rpartition(',')
+                if line_size.isdigit():
+                    size += int(line_size)
+    except FileNotFoundError:
+        return None, None
+    return files, size
+
+
+def read_distribution(path):
+    if path.suffix == '.dist-info':
+        headers = read_headers(path / 'METADATA')
+        files, size = read_record(path / 'RECORD')
+    else:
+        headers = read_headers(path / 'PKG-INFO')
+        files = size = None
+    try:
+        installer = (path / 'INSTALLER').read_text().strip()
+    except FileNotFoundError:
+        installer = None
+    return Distribution(name=headers.get('Name'),
+                        version=headers.get('Version'),
+                        summary=headers.get('Summary'),
+                        requires=headers.get_all('Requires-Dist') or [],
+                        installer=installer, files=files, size=size)
+
+
+class InventoryService:
+
+    def __init__(self):
+        # site-packages path -> (mtime, {canonical name: Distribution})
+        self.cache = {}
+
+    @staticmethod
+    def site_packages(venv_path):
+        paths = sorted(venv_path.glob('lib/python*/site-packages'))
+        if not paths:
+            raise FileNotFoundError("No site-packages in '%s'" % venv_path)
+        return paths[-1]
+
+    def _scan(self, venv_path):
+        site_packages = self.site_packages(venv_path.resolve())
+        # Venvs don't change after a successful deployment; the directory
+        # mtime still catches one that is being installed into
+        mtime = site_packages.stat().st_mtime
+        cached = self.cache.get(site_packages)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        distributions = {}
+        for path in site_packages.iterdir():
+            if path.suffix not in ('.dist-info', '.egg-info') or \
+                    not path.is_dir():
+                continue
+            try:
+                dist = read_distribution(path)
+            except (OSError, ValueError):
+                logger.warning("Cannot read distribution '%s'", path,
+                               exc_info=True)
+                continue
+            if dist.name:
+                distributions[canonical_name(dist.name)] = dist
+        self.cache[site_packages] = (mtime, distributions)
+        return distributions
+
+    async def get_distributions(self, venv_path):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._scan, venv_path)
+
+    def forget(self, venv_path):
+        venv_path = venv_path.resolve()
+        for site_packages in list(self.cache):
+            if venv_path in site_packages.parents:
+                del self.cache[site_packages]
+
+    async def list_packages(self, venv_path):
+        distributions = await self.get_distributions(venv_path)
+        return [dict(dist._asdict()) for _, dist
+                in sorted(distributions.items())]
+
+    async def diff(self, venv_path, other_path):
+        old, new = await asyncio.gather(self.get_distributions(venv_path),
+                                        self.get_distributions(other_path))
+        added = [{'name': new[key].name, 'version': new[key].version}
+                 for key in sorted(new.keys() - old.keys())]
+        removed = [{'name': old[key].name, 'version': old[key].version}
+                   for key in sorted(old.keys() - new.keys())]
+        changed = []
+        unchanged = 0
+        for key in sorted(old.keys() & new.keys()):
+            if old[key].version == new[key].version:
+                unchanged += 1
+            else:
+                changed.append({'name': new[key].name,
+                                'from': old[key].version,
+                                'to': new[key].version})
+        return {'added': added, 'removed': removed, 'changed': changed,
+                'unchanged': unchanged}
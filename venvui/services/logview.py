@@ -32,18 +32,23 @@ def parse_journal_line(line):
 
 
 class LogViewService:
-    def __init__(self):
-        pass
+    def __init__(self, executor=None):
+        self.pool = executor['follow'] if executor else None
 
-    async def get_systemd_log(self, unit, lines):
+    def get_systemd_log(self, unit, lines):
+        # Refused before the response starts streaming
+        if self.pool:
+            self.pool.check()
+        return self._follow_systemd_log(unit, lines)
+
+    async def _follow_systemd_log(self, unit, lines):
         command = ('journalctl', '--user', '--follow',  '--output=json',
                    '--unit=' + unit, '--lines=%s' % lines,)
         stream_log = StreamLog()
 
-        def stdout_callback(line):
-            obj = parse_journal_line(line)
-            if obj:
-                stream_log.put(**obj)
+        def stdout_callback(lines):
+            stream_log.put_many([obj for obj in map(parse_journal_line, lines)
+                                 if obj])
 
         def process_closed(future):
             returncode = future.result()
@@ -51,7 +56,8 @@ class LogViewService:
                          ' '.join(command), returncode)
             stream_log.close()
 
-        controller = SubProcessController(stdout_callback, None)
+        controller = SubProcessController(stdout_callback, None, chunked=True,
+                                          pool=self.pool)
         # Start process
         process = await controller.start(*command)
         logger.debug("Process started (%s), pid: %s", ' '.join(command),
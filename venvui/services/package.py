@@ -4,8 +4,6 @@ from datetime import datetime
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 
-import pkginfo
-
 from venvui.utils.misc import save_part_to_file
 
 
@@ -13,6 +11,8 @@ class PackageService:
     def __init__(self, package_root, temp_path):
         self.package_root = Path(package_root)
         self.temp_path = Path(temp_path)
+        # Bumped on every upload, for ETags
+        self.version = 0
         if not self.package_root.exists() or not self.package_root.is_dir():
             raise NotADirectoryError("%s must be a directory" %
                                      self.package_root)
@@ -20,7 +20,7 @@ class PackageService:
             raise NotADirectoryError("%s must be a directory" % self.temp_path)
 
     @staticmethod
-    def package_info(path):
+    def package_info(path, with_metadata=True):
         path = Path(path)
         if not path.exists():
             raise FileNotFoundError("File not found")
@@ -32,13 +32,21 @@ class PackageService:
              'filename': str(path.name)}
         pkg = None
 
+        if path.suffix == '.whl':
+            d['type'] = 'wheel'
+        elif path.suffix in ('.gz', '.bz2'):
+            d['type'] = 'sdist'
+        if not with_metadata:
+            # Parsing the archive is the expensive part
+            return d
+
+        # Only needed for metadata, kept off the startup import path
+        import pkginfo
         try:
-            if path.suffix == '.whl':
+            if d['type'] == 'wheel':
                 pkg = pkginfo.Wheel(path)
-                d['type'] = 'wheel'
-            elif path.suffix in ('.gz', '.bz2'):
+            elif d['type'] == 'sdist':
                 pkg = pkginfo.SDist(path)
-                d['type'] = 'sdist'
         except ValueError as e:
             d['error'] = str(e)
 
@@ -46,11 +54,11 @@ class PackageService:
             d['metadata'] = {k: getattr(pkg, k, None) for k in pkg}
         return d
 
-    def list_packages(self):
+    def list_packages(self, with_metadata=True):
         if not self.package_root.exists() or not self.package_root.is_dir():
             raise NotADirectoryError("Path must be a directory")
         for path in self.package_root.iterdir():
-            yield self.package_info(path)
+            yield self.package_info(path, with_metadata=with_metadata)
 
     def get_package(self, name):
         try:
@@ -58,8 +66,20 @@ class PackageService:
         except FileNotFoundError:
             return None
 
+    def package_stat(self, name):
+        # Cheap enough to answer If-None-Match without parsing the archive
+        try:
+            return (self.package_root / name).stat()
+        except FileNotFoundError:
+            return None
+
+    def root_mtime(self):
+        # Catches packages added or removed behind our back
+        return self.package_root.stat().st_mtime_ns
+
     def save_package(self, from_path, filename):
         Path(from_path).rename(self.package_root / filename)
+        self.version += 1
 
     async def save_package_from_part(self, part):
         with NamedTemporaryFile(dir=self.temp_path, delete=False) as f:
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import logging
+import marshal
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def sample_stacks(thread_id, seconds, interval):
+    # Runs in a worker thread, sampling the event loop thread
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        if names:
+            stacks[';'.join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+class ProfilerService:
+
+    def __init__(self, max_seconds=300):
+        self.max_seconds = max_seconds
+        self.running = None
+
+    def _begin(self, kind, seconds):
+        if self.running:
+            raise ProfilerBusy("A %s profile is already running" %
+                               self.running)
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError("Duration must be between 0 and %s seconds" %
+                             self.max_seconds)
+        self.running = kind
+        logger.warning("Starting %s profile for %s s", kind, seconds)
+
+    async def profile_cpu(self, seconds, output='pstats'):
+        # Profiling modules are imported on demand, profiling is rare
+        import cProfile
+        import pstats
+        self._begin('cpu', seconds)
+        profiler = cProfile.Profile()
+        try:
+            # The profiler hooks the current thread, i.e. the event loop
+            profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self.running = None
+        stats = pstats.Stats(profiler)
+        if output == 'pstats':
+            return marshal.dumps(stats.stats)
+        stream = io.StringIO()
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(100)
+        return stream.getvalue().encode('utf-8')
+
+    async def profile_sampling(self, seconds, interval=0.005):
+        self._begin('sampling', seconds)
+        loop = asyncio.get_event_loop()
+        try:
+            stacks = await loop.run_in_executor(
+                None, sample_stacks, threading.get_ident(), seconds, interval)
+        finally:
+            self.running = None
+        lines = ['%s %d' % (stack, count)
+                 for stack, count in stacks.most_common()]
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    async def profile_memory(self, seconds, limit=50, frames=10):
+        import tracemalloc
+        self._begin('memory', seconds)
+        started = tracemalloc.is_tracing()
+        try:
+            if not started:
+                tracemalloc.start(frames)
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+        finally:
+            if not started:
+                tracemalloc.stop()
+            self.running = None
+        diff = after.compare_to(before, 'traceback')
+        lines = []
+        for stat in diff[:limit]:
+            lines.append('%+d B (%d B total), %+d blocks' % (
+                stat.size_diff, stat.size, stat.count_diff))
+            lines.extend(stat.traceback.format())
+            lines.append('')
+        return '\n'.join(lines).encode('utf-8')
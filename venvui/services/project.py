@@ -2,6 +2,8 @@
 
 import asyncio
 import logging
+import os
+import time
 from collections import namedtuple
 from datetime import datetime
 from pathlib import Path
@@ -10,13 +12,21 @@ from string import Template
 import toml
 from os import getenv
 
+from venvui.services.systemd import SystemdException
+from venvui.utils.persist import WriteBehind, write_atomic
+from venvui.utils.subproc import SubProcessController
+
 logger = logging.getLogger(__name__)
 
 
+class RollbackError(Exception):
+    pass
+
+
 class ProjectService:
 
     def __init__(self, project_root, deployment_svc, package_svc,
-                 systemd_svc, config_svc):
+                 systemd_svc, config_svc, executor=None):
         self.project_root = Path(project_root)
         assert self.project_root.exists()
         assert self.project_root.is_dir()
@@ -24,8 +34,15 @@ class ProjectService:
         self.package_svc = package_svc
         self.systemd_svc = systemd_svc
         self.config_svc = config_svc
+        self.executor = executor
+        self.writer = WriteBehind()
         # Project cache
         self.projects = {}
+        # Bumped on every change of the projects, for ETags
+        self.version = 0
+        self.ready = False
+        self.loaded = asyncio.Event()
+        self.load_time = None
         task = asyncio.ensure_future(self._load_projects())
         task.add_done_callback(lambda f: f.result())
 
@@ -33,22 +50,122 @@ class ProjectService:
         path = self.project_root / key
         project = Project(self, key, path, name=name).create()
         self.projects[key] = project
+        self.touch()
         return project
 
+    def touch(self):
+        self.version += 1
+
     def get_project(self, key):
         return self.projects.get(key)
 
     def list_projects(self):
         return list(self.projects.values())
 
+    async def flush(self):
+        await self.writer.flush()
+
+    def readiness(self):
+        return {'ready': self.ready,
+                'projects': len(self.projects),
+                'load_time': self.load_time}
+
+    async def _read_project(self, project):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, project.read_config)
+        except (FileNotFoundError, NotADirectoryError):
+            logger.warning("Cannot load project from '%s'", project.path,
+                           exc_info=True)
+            return None
+        except Exception:
+            logger.exception("Error loading project from '%s'", project.path)
+            return None
+        # Projects are listed as soon as their config is read, service
+        # status follows once all of them are known
+        self.projects[project.key] = project
+        self.touch()
+        return project
+
     async def _load_projects(self):
-        for child in self.project_root.iterdir():
-            try:
-                project = await Project(self, child.name, child).load()
-                self.projects[project.key] = project
-            except FileNotFoundError:
-                logger.warning("Cannot load project from '%s'", child,
-                               exc_info=True)
+        started = time.time()
+        loop = asyncio.get_event_loop()
+        children = await loop.run_in_executor(
+            None, lambda: list(self.project_root.iterdir()))
+        projects = await asyncio.gather(
+            *(self._read_project(Project(self, child.name, child))
+              for child in children))
+        services = {service: project.key
+                    for project in projects if project
+                    for service in project.config.services}
+        await self.systemd_svc.add_services(services)
+        self.ready = True
+        self.loaded.set()
+        self.load_time = time.time() - started
+        logger.info("Loaded %d projects (%d services) in %.3f s",
+                    len(self.projects), len(services), self.load_time)
+
+    async def reload_project(self, key):
+        loop = asyncio.get_event_loop()
+        project = self.projects.get(key)
+        if project and self.writer.owns(project.config_file):
+            # Our own write: memory is already at least as recent
+            await self.sync_services(project)
+            return
+        loaded = Project(self, key, self.project_root / key)
+        try:
+            await loop.run_in_executor(None, loaded.read_config)
+        except (FileNotFoundError, NotADirectoryError):
+            if project:
+                logger.info("Project '%s' was removed", key)
+                project.unload()
+                del self.projects[key]
+                self.touch()
+            return
+        if project is None:
+            logger.info("Project '%s' was added", key)
+            project = self.projects[key] = loaded
+            self.touch()
+        elif project.config != loaded.config:
+            logger.info("Project '%s' was changed", key)
+            project.config = loaded.config
+            self.touch()
+        await self.sync_services(project)
+
+    async def sync_services(self, project):
+        registered = {service for service, props
+                      in self.systemd_svc.services.items()
+                      if props['project_key'] == project.key}
+        wanted = set(project.config.services)
+        for service in registered - wanted:
+            self.systemd_svc.remove_service(service)
+        await self.systemd_svc.add_services(
+            {service: project.key for service in wanted - registered})
+
+    def _install_config_file(self, project, name, dry_run):
+        try:
+            result = project.install_config_file(name, dry_run=dry_run)
+            del result['generated']
+        except Exception as e:
+            logger.warning("Cannot install config file '%s' of '%s'", name,
+                           project.key, exc_info=True)
+            result = {'name': name, 'result': 'error',
+                      'error': '%s: %s' % (e.__class__.__name__, e)}
+        result['project_key'] = project.key
+        return result
+
+    async def install_config_files(self, project_key=None, template=None,
+                                   dry_run=False):
+        loop = asyncio.get_event_loop()
+        projects = ([self.projects[project_key]] if project_key
+                    else list(self.projects.values()))
+        futures = [loop.run_in_executor(None, self._install_config_file,
+                                        project, name, dry_run)
+                   for project in projects
+                   for name, config_file in project.config.config_files.items()
+                   if template is None or config_file['template'] == template]
+        for future in asyncio.as_completed(futures):
+            yield await future
 
     def global_variables(self):
         return {
@@ -57,13 +174,17 @@ class ProjectService:
 
 
 ProjectConfig = namedtuple(
-    'ProjectConfig', 'name created_at config_files services')
+    'ProjectConfig', 'name created_at config_files services retention')
+# Older project files have no retention policy
+ProjectConfig.__new__.__defaults__ = ({},)
 
 
 class Project:
     config_filename = 'project.toml'
     venv_pathname = 'venv'
     current_venv_name = 'current'
+    # Written into venvs whose deployment succeeded
+    deployed_marker = '.venvui-deployed'
 
     def __init__(self, svc, key, path, **config):
         self.svc = svc
@@ -77,62 +198,83 @@ class Project:
         cfg = {'name': self.key,
                'created_at': datetime.utcnow(),
                'config_files': {},
-               'services': []}
+               'services': [],
+               'retention': {}}
         cfg.update(config)
         return ProjectConfig(**cfg)
 
-    async def load(self):
+    def read_config(self):
         logger.debug("Loading project '%s' from '%s'", self.key,
                      self.config_file)
         if not self.path.is_dir():
             raise NotADirectoryError("'%s' is not a directory" % self.path)
         if not self.config_file.exists():
             raise FileNotFoundError("File '%s' not found" % self.config_file)
-        # Load config
         with open(self.config_file) as f:
             config = toml.load(f)
         self.config = ProjectConfig(**config)
-        # Init
-        for service in self.config.services:
-            await self.svc.systemd_svc.add_service(service, self.key)
+        return self
+
+    async def load(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.read_config)
+        await self.svc.systemd_svc.add_services(
+            {service: self.key for service in self.config.services})
         return self
 
     def unload(self):
-        # TODO: remove services
-        pass
+        for service in self.config.services:
+            self.svc.systemd_svc.remove_service(service)
 
     def create(self):
         logger.info("Creating project in: '%s'", self.path)
         self.path.mkdir()
         self.venv_path.mkdir()
-        self.save_config()
+        self.svc.writer.record(self.config_file, write_atomic(
+            self.config_file, self.dump_config(), durable=True))
         return self
 
     def get_config(self):
         return dict(self.config._asdict())
 
-    def save_config(self):
+    def dump_config(self):
+        return toml.dumps(self.config._asdict())
+
+    def save_config(self, durable=False):
         logger.debug("Saving project '%s' configuration to '%s'",
                      self.key, self.config_file)
-        with open(self.config_file, 'w') as f:
-            toml.dump(self.config._asdict(), f)
+        return self.svc.writer.schedule(self.config_file, self.dump_config,
+                                        durable=durable)
 
-    def change_config(self, **kwargs):
+    def change_config(self, durable=False, **kwargs):
         self.config = self.config._replace(**kwargs)
-        self.save_config()
+        self.svc.touch()
+        return self.save_config(durable=durable)
 
     # Properties
 
-    def summary(self, with_services=False):
-        output = {
-            'key': self.key,
-            'name': self.name,
-            'fullpath': self.fullpath,
-            'created_at': self.created_at
+    summary_fields = ('key', 'name', 'fullpath', 'created_at', 'services',
+                      'configs', 'deployments')
+
+    def summary(self, with_services=False, fields=None):
+        if fields is None:
+            fields = self.summary_fields[:5 if with_services else 4]
+        unknown = set(fields) - set(self.summary_fields)
+        if unknown:
+            raise ValueError("Unknown fields: %s" % ', '.join(sorted(unknown)))
+        # Only what was asked for is computed
+        getters = {
+            'key': lambda: self.key,
+            'name': lambda: self.name,
+            'fullpath': lambda: self.fullpath,
+            'created_at': lambda: self.created_at,
+            'services': lambda: self.get_systemd_services(simplified=True),
+            'configs': self.list_config_files,
+            'deployments': lambda: [
+                deployment.to_dict() for deployment
+                in self.svc.deployment_svc.list_deployments(self.key)]
         }
-        if with_services:
-            output['services'] = self.get_systemd_services(simplified=True)
-        return output
+        return {field: getters[field]() for field in fields}
 
     @property
     def name(self):
@@ -158,6 +300,7 @@ class Project:
             if deployment.state == 'failed':
                 logger.error("Deployment failed, so not symlinking")
                 return
+            self.mark_deployed(deployment.venv_name, deployment.key)
             self.symlink_venv(deployment.venv_name)
 
         return self.svc.deployment_svc.deploy(
@@ -167,11 +310,119 @@ class Project:
         symlink_path = self.venv_path / self.current_venv_name
         logger.info("Will symlink: %s -> %s", self.current_venv_name,
                     target_venv_name)
+        # Renaming over the old link is atomic: 'current' always exists
+        temp_path = self.venv_path / ('.%s-%d' % (self.current_venv_name,
+                                                  os.getpid()))
         try:
-            symlink_path.unlink()
+            temp_path.unlink()
         except FileNotFoundError:
             pass
-        symlink_path.symlink_to(target_venv_name)
+        temp_path.symlink_to(target_venv_name)
+        os.replace(str(temp_path), str(symlink_path))
+
+    def mark_deployed(self, venv_name, deployment_key):
+        write_atomic(self.venv_path / venv_name / self.deployed_marker,
+                     deployment_key + '\n')
+
+    def is_deployed(self, venv_name, current=None):
+        # The current venv was switched to, so it was deployed successfully
+        # even if it predates the marker
+        current = current or self.current_venv()
+        return venv_name == current or \
+            (self.venv_path / venv_name / self.deployed_marker).is_file()
+
+    def previous_venv(self):
+        # Most recent successful deployment before the current one
+        current = self.current_venv()
+        older = [name for name in self.list_venvs()
+                 if (current is None or name < current) and
+                 self.is_deployed(name, current)]
+        return older[-1] if older else None
+
+    async def validate_venv(self, venv_name):
+        venv_path = self.get_venv_path(venv_name)
+        if venv_path is None:
+            raise RollbackError("Venv '%s' not found" % venv_name)
+        python_path = venv_path / 'bin' / 'python'
+        if not (venv_path / 'pyvenv.cfg').is_file() or \
+                not os.access(str(python_path), os.X_OK):
+            raise RollbackError("Venv '%s' is incomplete" % venv_name)
+        # The interpreter it links to must still exist and start
+        sub = SubProcessController(
+            None, None,
+            pool=self.svc.executor['control'] if self.svc.executor else None)
+        code = await sub.execute(str(python_path), '-c', 'import site')
+        if code != 0:
+            raise RollbackError("Python of venv '%s' does not start "
+                                "(code: %d)" % (venv_name, code))
+        return venv_path
+
+    async def _restart_service(self, service, timeout):
+        systemd_svc = self.svc.systemd_svc
+        started = time.monotonic()
+        result = {'name': service}
+        try:
+            await systemd_svc.execute(service, 'restart')
+            result['status'] = await systemd_svc.wait_ready(service, timeout)
+        except SystemdException as e:
+            result['status'] = 'error'
+            result['error'] = str(e)
+        result['ready'] = result['status'] == 'active'
+        result['elapsed'] = time.monotonic() - started
+        return result
+
+    async def rollback(self, venv_name=None, timeout=30):
+        started = time.monotonic()
+        current = self.current_venv()
+        if venv_name is None:
+            venv_name = self.previous_venv()
+            if venv_name is None:
+                raise RollbackError("No previous venv to roll back to")
+        if venv_name == self.current_venv_name:
+            # The link itself, never a target of its own
+            venv_name = current
+        if venv_name == current:
+            raise RollbackError("Venv '%s' is already current" % venv_name)
+        if self.get_venv_path(venv_name) and \
+                not self.is_deployed(venv_name, current):
+            raise RollbackError("Venv '%s' was not deployed successfully"
+                                % venv_name)
+        await self.validate_venv(venv_name)
+        self.symlink_venv(venv_name)
+        switched = time.monotonic() - started
+        logger.warning("Project '%s' rolled back from '%s' to '%s'",
+                       self.key, current, venv_name)
+        services = await asyncio.gather(
+            *(self._restart_service(service, timeout)
+              for service in self.config.services))
+        return {'from': current,
+                'to': venv_name,
+                'switch_time': switched,
+                'services': services,
+                'ready': all(service['ready'] for service in services),
+                'recovery_time': time.monotonic() - started}
+
+    def current_venv(self):
+        try:
+            return os.readlink(str(self.venv_path / self.current_venv_name))
+        except OSError:
+            return None
+
+    def list_venvs(self):
+        if not self.venv_path.is_dir():
+            return []
+        # Hidden entries are venvs being deleted
+        return sorted(path.name for path in self.venv_path.iterdir()
+                      if path.is_dir() and not path.is_symlink() and
+                      not path.name.startswith('.'))
+
+    def get_venv_path(self, venv_name):
+        if venv_name == self.current_venv_name:
+            venv_name = self.current_venv()
+        if not venv_name or '/' in venv_name or venv_name.startswith('.'):
+            return None
+        path = self.venv_path / venv_name
+        return path if path.is_dir() else None
 
     def variables(self, include_global=True):
         vars = {}
@@ -184,15 +435,27 @@ class Project:
 
     # Services
 
-    def add_systemd_service(self, service):
+    def add_systemd_service(self, service, durable=False):
         systemd_services = list(self.config.services)
         systemd_services.append(service)
-        self.change_config(services=systemd_services)
+        return self.change_config(services=systemd_services, durable=durable)
 
-    def remove_systemd_service(self, service):
+    def remove_systemd_service(self, service, durable=False):
         systemd_services = list(self.config.services)
         systemd_services.remove(service)
-        self.change_config(services=systemd_services)
+        return self.change_config(services=systemd_services, durable=durable)
+
+    def set_retention(self, policy, durable=False):
+        retention = {}
+        for key in ('keep_last', 'keep_days'):
+            if policy.get(key) is None:
+                continue
+            value = policy[key]
+            if not isinstance(value, int) or isinstance(value, bool) or \
+                    value < 0:
+                raise ValueError("'%s' must be a non-negative integer" % key)
+            retention[key] = value
+        return self.change_config(retention=retention, durable=durable)
 
     async def _get_systemd_services(self):
         services = []
@@ -203,7 +466,8 @@ class Project:
     def get_systemd_services(self, simplified=False):
         services = self.svc.systemd_svc.list_services(by_project_key=self.key)
         if simplified:
-            services = {s['name']: s['status'] for s in services}
+            # Status is unknown (None) until the first poll completes
+            services = {s['name']: s.get('status') for s in services}
         return services
 
     async def get_systemd_service(self, service):
@@ -233,13 +497,14 @@ class Project:
         return [self.get_config_file(name)
                 for name in self.config.config_files]
 
-    def add_config_file(self, name, template, path, variables):
+    def add_config_file(self, name, template, path, variables,
+                        durable=False):
         config_files = dict(self.config.config_files)
         config_files[name] = dict(template=template,
                                   path=path, variables=variables)
-        self.change_config(config_files=config_files)
+        return self.change_config(config_files=config_files, durable=durable)
 
-    def change_config_file(self, name, partial):
+    def change_config_file(self, name, partial, durable=False):
         config_files = dict(self.config.config_files)
         if 'name' in partial:
             new_name = partial.pop('name')
@@ -253,12 +518,12 @@ class Project:
             if key in ('template', 'variables', 'path'):
                 config_files[name][key] = value
 
-        self.change_config(config_files=config_files)
+        return self.change_config(config_files=config_files, durable=durable)
 
-    def remove_config_file(self, name):
+    def remove_config_file(self, name, durable=False):
         config_files = dict(self.config.config_files)
         del config_files[name]
-        self.change_config(config_files=config_files)
+        return self.change_config(config_files=config_files, durable=durable)
 
     def interpolated_variables(self, variables):
         project_variables = self.variables()
@@ -268,12 +533,19 @@ class Project:
     def interpolate_var(self, value):
         return Template(value).substitute(self.variables())
 
-    def install_config_file(self, name):
+    def install_config_file(self, name, dry_run=False):
         config_file = self.config.config_files[name]
         full_path = Path(self.interpolate_var(config_file['path'])).absolute()
         config_file = dict(name=name, full_path=str(full_path), **config_file)
         variables = self.interpolated_variables(config_file['variables'])
-        generated = self.svc.config_svc.install_file(
-            config_file['template'], full_path, variables)
+        if dry_run:
+            generated, diff = self.svc.config_svc.diff_file(
+                config_file['template'], full_path, variables)
+            config_file['diff'] = diff
+            changed = bool(diff)
+        else:
+            generated, changed = self.svc.config_svc.install_file(
+                config_file['template'], full_path, variables)
         config_file['generated'] = generated
+        config_file['result'] = 'changed' if changed else 'unchanged'
         return config_file
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque, namedtuple
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+Sample = namedtuple(
+    'Sample', 'time memory cpu_usec pids io_rbytes io_wbytes')
+
+
+def read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+    return None if value == 'max' else int(value)
+
+
+def read_keyed(path):
+    # Flat keyed files, like cpu.stat: "usage_usec 1234\nuser_usec 1000"
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return {}
+    result = {}
+    for line in lines:
+        key, _, value = line.partition(' ')
+        if value:
+            result[key] = int(value)
+    return result
+
+
+def read_io_stat(path):
+    # Nested keyed: "8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0"
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None, None
+    rbytes = wbytes = 0
+    for line in lines:
+        for field in line.split()[1:]:
+            key, _, value = field.partition('=')
+            if key == 'rbytes':
+                rbytes += int(value)
+            elif key == 'wbytes':
+                wbytes += int(value)
+    return rbytes, wbytes
+
+
+class ResourceMonitor:
+
+    def __init__(self, cgroup_root='/sys/fs/cgroup', manager_path=None,
+                 interval=5, history=120):
+        self.cgroup_root = Path(cgroup_root)
+        if manager_path is None:
+            uid = os.getuid()
+            manager_path = ('user.slice/user-%d.slice/user@%d.service' %
+                            (uid, uid))
+        self.manager_path = self.cgroup_root / manager_path
+        self.interval = interval
+        self.history = history
+        # unit -> deque of Sample
+        self.samples = {}
+        # unit -> resolved cgroup directory
+        self.paths = {}
+        task = asyncio.ensure_future(self.run())
+        task.add_done_callback(lambda f: f.result())
+
+    async def run(self):
+        while True:
+            self.sample_all()
+            await asyncio.sleep(self.interval)
+
+    def track(self, unit):
+        if unit not in self.samples:
+            logger.debug("Tracking resources of unit '%s'", unit)
+            self.samples[unit] = deque(maxlen=self.history)
+
+    def untrack(self, unit):
+        self.samples.pop(unit, None)
+        self.paths.pop(unit, None)
+
+    def unit_path(self, unit):
+        path = self.paths.get(unit)
+        if path and path.is_dir():
+            return path
+        # Units live either directly under the user manager or inside one
+        # of its slices (app.slice, session.slice, ...)
+        candidates = [self.manager_path / unit]
+        if self.manager_path.is_dir():
+            candidates.extend(self.manager_path.glob('*.slice/' + unit))
+        for candidate in candidates:
+            if candidate.is_dir():
+                self.paths[unit] = candidate
+                return candidate
+        self.paths.pop(unit, None)
+        return None
+
+    def read_sample(self, path):
+        cpu = read_keyed(path / 'cpu.stat')
+        rbytes, wbytes = read_io_stat(path / 'io.stat')
+        return Sample(time=time.time(),
+                      memory=read_int(path / 'memory.current'),
+                      cpu_usec=cpu.get('usage_usec'),
+                      pids=read_int(path / 'pids.current'),
+                      io_rbytes=rbytes,
+                      io_wbytes=wbytes)
+
+    def sample(self, unit):
+        path = self.unit_path(unit)
+        if path is None:
+            # Unit is not running (no cgroup), keep history contiguous
+            return None
+        sample = self.read_sample(path)
+        self.samples[unit].append(sample)
+        return sample
+
+    def sample_all(self):
+        for unit in list(self.samples):
+            try:
+                self.sample(unit)
+            except (OSError, ValueError):
+                logger.warning("Cannot sample resources of unit '%s'", unit,
+                               exc_info=True)
+
+    def get_history(self, unit):
+        if unit not in self.samples:
+            raise KeyError("Unit '%s' is not tracked" % unit)
+        return [s._asdict() for s in self.samples[unit]]
+
+    def get_current(self, unit):
+        samples = self.samples.get(unit)
+        if not samples:
+            return None
+        last = samples[-1]
+        current = {'memory': last.memory,
+                   'pids': last.pids,
+                   'io_rbytes': last.io_rbytes,
+                   'io_wbytes': last.io_wbytes,
+                   'cpu_usec': last.cpu_usec,
+                   'cpu_percent': None,
+                   'sampled_at': last.time}
+        if len(samples) > 1:
+            prev = samples[-2]
+            elapsed = last.time - prev.time
+            if (elapsed > 0 and last.cpu_usec is not None and
+                    prev.cpu_usec is not None):
+                used = max(last.cpu_usec - prev.cpu_usec, 0)
+                current['cpu_percent'] = used / (elapsed * 1e6) * 100
+        return current
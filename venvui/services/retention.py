@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+from venvui.utils.metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+VENVS_REMOVED = Counter(
+    'venvui_venvs_removed_total', 'Venvs removed by the retention policy')
+VENV_BYTES_FREED = Counter(
+    'venvui_venv_bytes_freed_total', 'Disk space freed by removing venvs')
+VENV_BYTES = Gauge(
+    'venvui_venv_disk_usage_bytes', 'Disk space used by measured venvs')
+VENV_DELETES_PENDING = Gauge(
+    'venvui_venv_deletes_pending', 'Venvs waiting to be deleted')
+
+# Venvs being deleted are renamed first, so they vanish from listings at once
+TRASH_PREFIX = '.trash-'
+ACTIVE_STATES = ('pending', 'running')
+
+
+def disk_usage(path):
+    # Allocated bytes and number of files; a file hardlinked several times
+    # inside the tree is counted once, and bytes of files that are also
+    # linked from elsewhere are reported as shared
+    seen = set()
+    size = shared = files = 0
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                stat = entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    size += stat.st_blocks * 512
+                    continue
+                if stat.st_nlink > 1:
+                    if (stat.st_dev, stat.st_ino) in seen:
+                        continue
+                    seen.add((stat.st_dev, stat.st_ino))
+                    shared += stat.st_blocks * 512
+                files += 1
+                size += stat.st_blocks * 512
+    return {'size': size, 'shared': shared, 'files': files}
+
+
+def removal_steps(path):
+    # Bottom-up, so directories are empty by the time they are removed
+    for dirpath, dirnames, filenames in os.walk(str(path), topdown=False):
+        for name in filenames:
+            yield os.unlink, os.path.join(dirpath, name)
+        for name in dirnames:
+            # Symlinks to directories are listed here but not walked
+            if os.path.islink(os.path.join(dirpath, name)):
+                yield os.unlink, os.path.join(dirpath, name)
+        yield os.rmdir, dirpath
+
+
+def remove_some(steps, limit):
+    # Returns how many entries were removed, and whether the tree is gone
+    for count in range(limit):
+        try:
+            remove, path = next(steps)
+        except StopIteration:
+            return count, True
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+    return limit, False
+
+
+class VenvCollector:
+
+    def __init__(self, project_svc, inventory_svc=None, dedup_svc=None,
+                 keep_last=3, keep_days=7, interval=3600, delete_rate=2000,
+                 delete_rate_deploying=200, enabled=False):
+        self.project_svc = project_svc
+        self.inventory_svc = inventory_svc
+        self.dedup_svc = dedup_svc
+        # Defaults, overridden by the [retention] table of a project
+        self.keep_last = keep_last
+        self.keep_days = keep_days
+        self.interval = interval
+        # Files deleted per second, lower while deployments run so that
+        # pip keeps most of the disk
+        self.delete_rate = delete_rate
+        self.delete_rate_deploying = delete_rate_deploying
+        self.enabled = enabled
+        # venv path -> disk usage; venvs don't change once deployed, so
+        # each one is only walked once
+        self.usage = {}
+        self.measuring = set()
+        # trash path -> (project key, venv name, bytes)
+        self.trash = {}
+        self.queue = asyncio.Queue()
+        self.wakeup = asyncio.Event()
+        VENV_BYTES.set_function(
+            lambda: sum(usage['size'] for usage in self.usage.values()))
+        VENV_DELETES_PENDING.set_function(lambda: len(self.trash))
+        for coroutine in (self.run(), self._delete_worker()):
+            task = asyncio.ensure_future(coroutine)
+            task.add_done_callback(lambda f: f.result())
+
+    @property
+    def deployment_svc(self):
+        return self.project_svc.deployment_svc
+
+    async def run(self):
+        await self.project_svc.loaded.wait()
+        for project in self.project_svc.list_projects():
+            self._resume_trash(project)
+        while True:
+            if self.enabled:
+                for project in self.project_svc.list_projects():
+                    try:
+                        self.collect(project)
+                    except Exception:
+                        # One broken project must not stop the collector
+                        logger.exception("Cannot collect venvs of '%s'",
+                                         project.key)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def policy(self, project):
+        policy = {'keep_last': self.keep_last, 'keep_days': self.keep_days}
+        policy.update(project.config.retention)
+        return policy
+
+    def active_venvs(self, project):
+        return {deployment.venv_name for deployment
+                in self.deployment_svc.list_deployments(project.key)
+                if deployment.state in ACTIVE_STATES}
+
+    @staticmethod
+    def created_at(project, venv_name):
+        # Venvs are named after the UTC time of their deployment
+        try:
+            return (datetime.strptime(venv_name, '%Y%m%d-%H%M%S') -
+                    datetime(1970, 1, 1)).total_seconds()
+        except ValueError:
+            return (project.venv_path / venv_name).stat().st_mtime
+
+    def plan(self, project, with_usage=True):
+        policy = self.policy(project)
+        venvs = project.list_venvs()
+        current = project.current_venv()
+        # Kept so that a rollback never needs a redeploy
+        previous = project.previous_venv()
+        active = self.active_venvs(project)
+        last = set(venvs[-policy['keep_last']:]
+                   if policy['keep_last'] > 0 else [])
+        cutoff = time.time() - policy['keep_days'] * 86400
+        plan = []
+        for name in venvs:
+            reasons = []
+            if name == current:
+                reasons.append('current')
+            if name == previous:
+                reasons.append('previous')
+            if name in active:
+                reasons.append('deploying')
+            if name in last:
+                reasons.append('last')
+            if self.created_at(project, name) >= cutoff:
+                reasons.append('recent')
+            plan.append({'name': name,
+                         'keep': bool(reasons),
+                         'reasons': reasons,
+                         'usage': (self.get_usage(project, name, active)
+                                   if with_usage else None)})
+        return plan
+
+    def collect(self, project, dry_run=False):
+        plan = self.plan(project, with_usage=dry_run)
+        for venv in plan:
+            if venv['keep'] or dry_run:
+                continue
+            self._discard(project, venv['name'])
+        return plan
+
+    def _discard(self, project, venv_name):
+        path = project.venv_path / venv_name
+        trash = project.venv_path / (TRASH_PREFIX + venv_name)
+        if self.inventory_svc:
+            self.inventory_svc.forget(path)
+        path.rename(trash)
+        logger.info("Removing venv '%s' of '%s'", venv_name, project.key)
+        usage = self.usage.pop(path, None)
+        self.trash[trash] = (project.key, venv_name,
+                             usage['size'] if usage else 0)
+        self.queue.put_nowait(trash)
+
+    def _resume_trash(self, project):
+        if not project.venv_path.is_dir():
+            return
+        for path in project.venv_path.iterdir():
+            if path.name.startswith(TRASH_PREFIX) and path not in self.trash:
+                self.trash[path] = (project.key,
+                                    path.name[len(TRASH_PREFIX):], 0)
+                self.queue.put_nowait(path)
+
+    def get_usage(self, project, venv_name, active=()):
+        path = project.venv_path / venv_name
+        usage = self.usage.get(path)
+        # Venvs still being installed into are measured once finished
+        if usage is None and path not in self.measuring and \
+                venv_name not in active:
+            self.measuring.add(path)
+            task = asyncio.ensure_future(self._measure(path))
+            task.add_done_callback(lambda f: f.result())
+        return usage
+
+    async def _measure(self, path):
+        loop = asyncio.get_event_loop()
+        try:
+            self.usage[path] = await loop.run_in_executor(None, disk_usage,
+                                                          path)
+        except FileNotFoundError:
+            pass
+        finally:
+            self.measuring.discard(path)
+
+    def project_usage(self, project):
+        active = self.active_venvs(project)
+        sizes = [self.get_usage(project, name, active)
+                 for name in project.list_venvs()]
+        known = [usage for usage in sizes if usage]
+        return {'venvs': len(sizes),
+                'measured': len(known),
+                'size': sum(usage['size'] for usage in known),
+                'files': sum(usage['files'] for usage in known)}
+
+    def deploying(self):
+        return any(deployment.state in ACTIVE_STATES
+                   for deployment in self.deployment_svc.list_deployments())
+
+    async def _delete_worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            path = await self.queue.get()
+            started = time.time()
+            project_key, venv_name, size = self.trash[path]
+            if self.dedup_svc:
+                # Its files must not be used as link targets anymore
+                try:
+                    await self.dedup_svc.forget(path.parent / venv_name)
+                except Exception:
+                    logger.exception("Cannot forget '%s' in the dedup "
+                                     "index", venv_name)
+            steps = removal_steps(path)
+            done = False
+            while not done:
+                rate = (self.delete_rate_deploying if self.deploying()
+                        else self.delete_rate)
+                # Ten batches per second at the current rate
+                batch = max(int(rate / 10), 1)
+                batch_started = time.monotonic()
+                try:
+                    count, done = await loop.run_in_executor(
+                        None, remove_some, steps, batch)
+                except OSError:
+                    logger.exception("Cannot delete '%s'", path)
+                    break
+                elapsed = time.monotonic() - batch_started
+                await asyncio.sleep(max(count / rate - elapsed, 0))
+            self.trash.pop(path)
+            if done:
+                VENVS_REMOVED.inc()
+                VENV_BYTES_FREED.inc(size)
+                logger.info("Removed venv '%s' of '%s' in %.1f s",
+                            venv_name, project_key, time.time() - started)
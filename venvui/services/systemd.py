@@ -3,41 +3,159 @@
 import asyncio
 from asyncio import subprocess
 import logging
+import time
 
+from venvui.utils.subproc import SUBPROCESS_SPAWNED, SUBPROCESS_DURATION
+from venvui.utils.subproc import ExecutorSaturated
 
 logger = logging.getLogger(__name__)
 
+# Units in these states are polled at the fast interval
+TRANSITIONAL_STATES = ('activating', 'deactivating', 'reloading')
+
 
 class SystemdException(Exception):
     pass
 
 
+# Token bucket limiting how many systemctl calls are made per second
+class CallBudget:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self):
+        # Explicit calls (commands, status requests) are never refused, they
+        # just leave the bucket in debt so that polling yields to them
+        self._refill()
+        self.tokens -= 1
+
+    def delay(self):
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
 class SystemdManager:
 
-    def __init__(self, logview_svc, polling_time=10):
+    def __init__(self, logview_svc, resource_svc=None, polling_time=10,
+                 fast_polling_time=0.5, max_polling_time=120,
+                 command_window=15, max_calls_per_second=5, executor=None):
         self.logview_svc = logview_svc
+        self.pool = executor['control'] if executor else None
+        self.resource_svc = resource_svc
         self.cmd_prefix = ['systemctl', '--user', '--no-legend']
         self.services = {}
+        # Bumped on every change of the services, for ETags
+        self.version = 0
         self.polling_time = polling_time
+        self.fast_polling_time = fast_polling_time
+        self.max_polling_time = max_polling_time
+        self.command_window = command_window
+        self.budget = CallBudget(max_calls_per_second)
+        # service -> (next poll time, current interval)
+        self.schedule = {}
+        # service -> time of the last command executed on it
+        self.commanded = {}
+        self.wakeup = asyncio.Event()
         task = asyncio.ensure_future(self.run())
         task.add_done_callback(lambda f: f.result())
 
     async def run(self):
         while True:
-            await self._update_active_bulk()
-            await asyncio.sleep(self.polling_time)
+            delay = self.budget.delay()
+            if not delay:
+                now = time.monotonic()
+                due = [service for service, (next_poll, _)
+                       in self.schedule.items() if next_poll <= now]
+                try:
+                    if due:
+                        await self._update_active_bulk(due)
+                    delay = self._next_poll_delay()
+                except ExecutorSaturated:
+                    # Requests have the slots, polling is retried later
+                    logger.debug("No slot for polling, retrying")
+                    delay = self.fast_polling_time
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _next_poll_delay(self):
+        if not self.schedule:
+            return self.max_polling_time
+        next_poll = min(next_poll for next_poll, _ in self.schedule.values())
+        return max(next_poll - time.monotonic(), 0)
+
+    def _reschedule(self, service, changed):
+        now = time.monotonic()
+        _, interval = self.schedule.get(service, (now, self.polling_time))
+        status = self.services[service].get('status')
+        recently_commanded = (now - self.commanded.get(service, -1e9) <
+                              self.command_window)
+        if status in TRANSITIONAL_STATES or recently_commanded:
+            interval = self.fast_polling_time
+        elif changed:
+            interval = self.polling_time
+        else:
+            # Stable unit: back off exponentially
+            interval = min(max(interval * 2, self.polling_time),
+                           self.max_polling_time)
+        self.schedule[service] = (now + interval, interval)
 
     async def add_service(self, service, project_key):
         logger.debug("Adding service '%s' from '%s'", service, project_key)
         self.services[service] = {'project_key': project_key}
+        if self.resource_svc:
+            self.resource_svc.track(service)
         await self._update_status(service)
         return dict(self.services[service])
 
+    async def add_services(self, services):
+        # services: mapping of service name -> project key
+        for service, project_key in services.items():
+            logger.debug("Adding service '%s' from '%s'", service,
+                         project_key)
+            self.services[service] = {'project_key': project_key}
+            if self.resource_svc:
+                self.resource_svc.track(service)
+        await self._update_status_bulk(list(services))
+
+    def remove_service(self, service):
+        if self.services.pop(service, None) is None:
+            return
+        logger.debug("Removing service '%s'", service)
+        self.version += 1
+        self.schedule.pop(service, None)
+        self.commanded.pop(service, None)
+        if self.resource_svc:
+            self.resource_svc.untrack(service)
+
     async def get_status(self, service):
         if service not in self.services:
             raise KeyError("Service '%s' unknown" % service)
         await self._update_status(service)
-        return dict(self.services[service])
+        status = dict(self.services[service])
+        if self.resource_svc:
+            status['resources'] = self.resource_svc.get_current(service)
+        return status
+
+    def get_resources(self, service):
+        if service not in self.services:
+            raise KeyError("Service '%s' unknown" % service)
+        if not self.resource_svc:
+            return []
+        return self.resource_svc.get_history(service)
 
     def list_services(self, by_project_key=None):
         services = self.services.items()
@@ -53,6 +171,7 @@ class SystemdManager:
         return self.logview_svc.get_systemd_log(service, lines)
 
     async def execute(self, service, command):
+        self.commanded[service] = time.monotonic()
         out, err, code = await self._execute(command, service)
         out = out.strip() + err.strip()
         if code != 0:
@@ -60,35 +179,98 @@ class SystemdManager:
         await self._update_status(service)
         return out
 
-    async def _execute(self, *args, **kwargs):
+    async def wait_ready(self, service, timeout=30):
+        # Polls until the unit leaves the transitional states; the unit is
+        # ready if it ended up active
+        deadline = time.monotonic() + timeout
+        while True:
+            await self._update_status(service)
+            status = self.services[service].get('status')
+            if status not in TRANSITIONAL_STATES or \
+                    time.monotonic() >= deadline:
+                return status
+            await asyncio.sleep(self.fast_polling_time)
+
+    async def _execute(self, *args, pool=None, **kwargs):
+        # pool: an Admission shared by a batch of commands, admitted once
+        pool = pool or self.pool
+        if pool is None:
+            return await self._systemctl(*args, **kwargs)
+        async with pool.slot():
+            return await self._systemctl(*args, **kwargs)
+
+    async def _systemctl(self, *args, **kwargs):
+        self.budget.consume()
         pipe = subprocess.PIPE
         logger.debug("Executing: systemctl %s", ' '.join(args))
+        started = time.monotonic()
         proc = await asyncio.create_subprocess_exec(
             *self.cmd_prefix, *args, stdin=None, stdout=pipe, stderr=pipe,
             **kwargs)
+        SUBPROCESS_SPAWNED.labels('systemctl').inc()
         out, err = await proc.communicate()
+        SUBPROCESS_DURATION.labels('systemctl').observe(
+            time.monotonic() - started)
         out = out.decode('utf-8', 'ignore')
         err = err.decode('utf-8', 'ignore')
         logger.debug("Finished with code: %s, out: %r, err: %r",
                      proc.returncode, out, err)
         return out, err, proc.returncode
 
-    async def _update_status(self, service):
+    def _set_status(self, service, output):
+        changed = any(self.services[service].get(key) != value
+                      for key, value in output.items())
+        if changed:
+            logger.info("Service '%s' changed: %s", service, output)
+            self.version += 1
+        self.services[service].update(output)
+        self._reschedule(service, changed)
+        # The schedule may now be shorter than what the poller is waiting for
+        self.wakeup.set()
+
+    async def _update_status(self, service, pool=None):
         output = {}
-        out, err, code = await self._execute('is-enabled', service)
+        out, err, code = await self._execute('is-enabled', service,
+                                             pool=pool)
         output['startup'] = 'error' if err else out.strip()
         output['error'] = err.strip() if err else None
-        out, err, code = await self._execute('is-active', service)
+        out, err, code = await self._execute('is-active', service, pool=pool)
         output['status'] = out.strip()
-        # TODO: detect changes
-        self.services[service].update(output)
+        self._set_status(service, output)
+
+    async def _update_status_bulk(self, services):
+        if not services:
+            return
+        (enabled, err, _), (active, _, _) = await asyncio.gather(
+            self._execute('is-enabled', *services),
+            self._execute('is-active', *services))
+        enabled = enabled.strip().split('\n')
+        active = active.strip().split('\n')
+        if err or len(enabled) != len(services) or \
+                len(active) != len(services):
+            # Errors on stderr cannot be matched to units, so fall back to
+            # querying them one by one, admitted as one batch: however many
+            # units there are, they queue for slots instead of being refused
+            admission = self.pool.admit() if self.pool else None
+            try:
+                await asyncio.gather(*(self._update_status(service,
+                                                           pool=admission)
+                                       for service in services))
+            finally:
+                if admission:
+                    admission.close()
+            return
+        for service, startup, status in zip(services, enabled, active):
+            self._set_status(service, {'startup': startup, 'error': None,
+                                       'status': status})
 
-    async def _update_active_bulk(self):
-        if not self.services:
+    async def _update_active_bulk(self, services=None):
+        services = list(self.services if services is None else services)
+        if not services:
             return
-        out, err, code = await self._execute('is-active', *self.services)
+        out, err, code = await self._execute('is-active', *services)
         status = out.strip().split('\n')
         assert err == '', err
-        for service, status in zip(self.services, status):
-            # TODO: detect changes
-            self.services[service]['status'] = status
+        for service, status in zip(services, status):
+            if service in self.services:
+                self._set_status(service, {'status': status})
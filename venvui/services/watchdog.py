@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+from venvui.utils.metrics import Counter, Histogram, format_value
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = Histogram(
+    'venvui_event_loop_lag_seconds', 'Event loop scheduling lag',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+LOOP_BLOCKED = Counter(
+    'venvui_event_loop_blocked_total',
+    'Times the event loop was blocked longer than the threshold')
+
+package_path = str(Path(__file__).parent.parent)
+
+
+class LoopMonitor:
+
+    def __init__(self, interval=0.1, threshold=0.25, stack_limit=30):
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_limit = stack_limit
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = None
+        self.heartbeat = time.monotonic()
+        self.expected = self.heartbeat + interval
+        # Stack captured by the watchdog thread for the current heartbeat
+        self.captured = None
+        # site -> {'count', 'total', 'max', 'stack'}
+        self.sites = {}
+        self.loop.call_soon(self._tick)
+        thread = threading.Thread(target=self._watch, name='LoopWatchdog',
+                                  daemon=True)
+        thread.start()
+
+    def _tick(self):
+        now = time.monotonic()
+        if self.loop_thread is None:
+            self.loop_thread = threading.get_ident()
+        lag = max(now - self.expected, 0)
+        LOOP_LAG.observe(lag)
+        captured, self.captured = self.captured, None
+        if captured and captured[0] == self.heartbeat:
+            # Only the time beyond the expected wakeup was blocked
+            self._record(captured[1], lag)
+        self.heartbeat = now
+        self.expected = now + self.interval
+        self.loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat
+            if stalled < self.threshold + self.interval:
+                continue
+            if self.captured and self.captured[0] == heartbeat:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame, limit=self.stack_limit)
+            del frame
+            self.captured = (heartbeat, stack)
+            logger.warning("Event loop blocked for %.3f s at %s",
+                           stalled - self.interval, self._site(stack))
+
+    @staticmethod
+    def _site(stack):
+        # Innermost frame of our own code is the most useful culprit
+        for entry in reversed(stack):
+            if entry.filename.startswith(package_path):
+                break
+        else:
+            entry = stack[-1]
+        return '%s:%d in %s' % (entry.filename, entry.lineno, entry.name)
+
+    def _record(self, stack, blocked):
+        LOOP_BLOCKED.inc()
+        site = self._site(stack)
+        stats = self.sites.get(site)
+        if stats is None:
+            stats = self.sites[site] = {'count': 0, 'total': 0, 'max': 0}
+        stats['count'] += 1
+        stats['total'] += blocked
+        stats['max'] = max(stats['max'], blocked)
+        stats['stack'] = traceback.format_list(stack)
+
+    def lag_histogram(self):
+        child = LOOP_LAG.children[()]
+        bounds = child.upper_bounds + (float('inf'),)
+        buckets = [{'le': format_value(float(bound)), 'count': count}
+                   for bound, count in zip(bounds, child.counts)]
+        return {'buckets': buckets,
+                'count': sum(child.counts),
+                'sum': child.sum}
+
+    def top_sites(self, limit=10):
+        sites = sorted(self.sites.items(), key=lambda item: item[1]['total'],
+                       reverse=True)
+        return [dict(site=site, **stats) for site, stats in sites[:limit]]
+
+    def report(self, limit=10):
+        return {'threshold': self.threshold,
+                'interval': self.interval,
+                'lag': self.lag_histogram(),
+                'blocking': self.top_sites(limit)}
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+
+from venvui.utils import inotify
+
+logger = logging.getLogger(__name__)
+
+ROOT_MASK = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_TO |
+             inotify.IN_MOVED_FROM | inotify.IN_ONLYDIR)
+PROJECT_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+                inotify.IN_MOVED_FROM | inotify.IN_DELETE |
+                inotify.IN_ONLYDIR)
+
+
+class ProjectWatcher:
+
+    def __init__(self, project_svc, interval=5, debounce=0.5,
+                 use_inotify=True):
+        self.project_svc = project_svc
+        self.interval = interval
+        self.debounce = debounce
+        self.use_inotify = use_inotify
+        self.config_filename = 'project.toml'
+        # Keys of projects whose directory or config changed
+        self.dirty = set()
+        # Set when inotify dropped events, everything is looked at again
+        self.rescan = False
+        self.changed = asyncio.Event()
+        self.inotify = None
+        # Used by the mtime scanner: project key -> mtime
+        self.mtimes = {}
+        task = asyncio.ensure_future(self.run())
+        task.add_done_callback(lambda f: f.result())
+
+    @property
+    def project_root(self):
+        return self.project_svc.project_root
+
+    async def run(self):
+        await self.project_svc.loaded.wait()
+        loop = asyncio.get_event_loop()
+        if self.use_inotify:
+            try:
+                await loop.run_in_executor(None, self._start_inotify)
+            except OSError:
+                logger.warning("Cannot use inotify, falling back to "
+                               "scanning every %s s", self.interval,
+                               exc_info=True)
+                self._stop_inotify()
+        if self.inotify:
+            loop.add_reader(self.inotify.fileno(), self._read_inotify)
+            logger.info("Watching '%s' with inotify", self.project_root)
+        else:
+            self.mtimes = await loop.run_in_executor(None, self._scan)
+            logger.info("Watching '%s' by scanning", self.project_root)
+        while True:
+            if self.inotify:
+                await self.changed.wait()
+                # Let bursts of events settle (editors, atomic renames)
+                await asyncio.sleep(self.debounce)
+                self.changed.clear()
+                if self.rescan:
+                    self.rescan = False
+                    self.dirty.update(await loop.run_in_executor(
+                        None, self._rewatch))
+            else:
+                await asyncio.sleep(self.interval)
+                mtimes = await loop.run_in_executor(None, self._scan)
+                self.dirty.update(key for key in mtimes.keys() | self.mtimes
+                                  if mtimes.get(key) != self.mtimes.get(key))
+                self.mtimes = mtimes
+            dirty, self.dirty = self.dirty, set()
+            for key in sorted(dirty):
+                try:
+                    await self.project_svc.reload_project(key)
+                except Exception:
+                    logger.exception("Cannot reload project '%s'", key)
+
+    def _start_inotify(self):
+        self.inotify = inotify.Inotify()
+        self.inotify.add_watch(self.project_root, ROOT_MASK)
+        for child in self.project_root.iterdir():
+            if child.is_dir():
+                self.inotify.add_watch(child, PROJECT_MASK)
+
+    def _stop_inotify(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+    def _rewatch(self):
+        # Projects created while events were lost are not watched yet
+        keys = set(self.project_svc.projects)
+        for child in self.project_root.iterdir():
+            if child.is_dir():
+                self.inotify.add_watch(child, PROJECT_MASK)
+                keys.add(child.name)
+        return keys
+
+    def _read_inotify(self):
+        for event in self.inotify.read_events():
+            if event.mask & inotify.IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, rescanning '%s'",
+                               self.project_root)
+                self.rescan = True
+            elif event.path == self.project_root:
+                if not event.name:
+                    continue
+                if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO) \
+                        and event.mask & inotify.IN_ISDIR:
+                    try:
+                        self.inotify.add_watch(self.project_root / event.name,
+                                               PROJECT_MASK)
+                    except OSError:
+                        logger.warning("Cannot watch '%s'", event.name,
+                                       exc_info=True)
+                self.dirty.add(event.name)
+            elif event.name == self.config_filename:
+                self.dirty.add(event.path.name)
+            else:
+                continue
+            self.changed.set()
+
+    def _scan(self):
+        mtimes = {}
+        for child in self.project_root.iterdir():
+            try:
+                stat = (child / self.config_filename).stat()
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            mtimes[child.name] = stat.st_mtime_ns
+        return mtimes
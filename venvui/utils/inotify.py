@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import os
+import struct
+from collections import namedtuple
+from pathlib import Path
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_event_header = struct.Struct('iIII')
+
+InotifyEvent = namedtuple('InotifyEvent', 'path mask name')
+
+
+def _load_libc():
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+class Inotify:
+
+    def __init__(self):
+        self.libc = _load_libc()
+        if self.libc is None:
+            raise OSError("inotify is not available on this system")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # watch descriptor -> watched path
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(path)),
+                                         mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        self.watches[wd] = Path(path)
+        return wd
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            path = self.watches.get(wd)
+            if mask & IN_Q_OVERFLOW:
+                # Not tied to a watch (wd is -1): events were dropped
+                events.append(InotifyEvent(None, mask, ''))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            if path is not None:
+                events.append(InotifyEvent(path, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+        self.watches.clear()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# Minimal Prometheus instrumentation (text exposition format 0.0.4).
+# Recording only touches preallocated children: a dict lookup by label
+# values tuple plus an integer/float update.
+
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value))
+                             for name, value in zip(names, values))
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            metric.render(lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        # Value computed at scrape time
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class HistogramChild:
+    __slots__ = ('upper_bounds', 'counts', 'sum')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        # Last slot is the +Inf bucket
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(),
+                 registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+        registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("Expected labels: %s" % (self.labelnames,))
+            child = self.children[values] = self._new_child()
+        return child
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.documentation))
+        lines.append('# TYPE %s %s' % (self.name, self.type))
+        for values, child in list(self.children.items()):
+            self.render_child(lines, values, child)
+
+    def render_child(self, lines, values, child):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def render_child(self, lines, values, child):
+        lines.append('%s%s %s' % (self.name,
+                                  format_labels(self.labelnames, values),
+                                  format_value(child.value)))
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def set_function(self, function):
+        self.children[()].set_function(function)
+
+    def render_child(self, lines, values, child):
+        lines.append('%s%s %s' % (self.name,
+                                  format_labels(self.labelnames, values),
+                                  format_value(child.get())))
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return HistogramChild(self.upper_bounds)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def render_child(self, lines, values, child):
+        names = self.labelnames + ('le',)
+        cumulative = 0
+        bounds = self.upper_bounds + (float('inf'),)
+        for bound, count in zip(bounds, child.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (
+                self.name, format_labels(names, values + (format_value(
+                    float(bound)),)), cumulative))
+        labels = format_labels(self.labelnames, values)
+        lines.append('%s_sum%s %s' % (self.name, labels,
+                                      format_value(child.sum)))
+        lines.append('%s_count%s %d' % (self.name, labels, cumulative))
@@ -4,11 +4,21 @@ import datetime
 import json
 import random
 import string
+import time
+import zlib
 
 from aiohttp import web
 from aiohttp.web_response import StreamResponse
 
 
+# Version counters restart at zero, so ETags also carry the process start
+BOOT_ID = '%x' % int(time.time() * 1000)
+
+# request path and query -> (etag, serialized body)
+_body_cache = {}
+BODY_CACHE_SIZE = 256
+
+
 def keygen(n=8):
     random.seed(1)
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=n))
@@ -48,13 +58,80 @@ def jsonify(*a, status=200, reason=None, headers=None, content_type=None,
                         headers=headers, content_type=content_type)
 
 
+def negotiate_encoding(request):
+    accepted = {}
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ('gzip', 'deflate'):
+        if accepted.get(coding, 0) > 0:
+            return coding
+    return None
+
+
+def make_etag(*versions):
+    return '"%s-%s"' % (BOOT_ID, '.'.join(str(v) for v in versions))
+
+
+def check_etag(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return
+    tags = {tag.strip() for tag in if_none_match.split(',')}
+    tags = {tag[2:] if tag.startswith('W/') else tag for tag in tags}
+    if etag in tags or '*' in tags:
+        raise web.HTTPNotModified(headers={'ETag': etag})
+
+
+def cached_jsonify(request, etag, build, dumps=json_dumps):
+    # Answers If-None-Match before doing any work, and reuses the body
+    # serialized for the same etag and query; without an etag (content
+    # that changes by itself) the body is built every time
+    if etag is None:
+        return web.Response(text=dumps(build()),
+                            content_type='application/json')
+    check_etag(request, etag)
+    key = request.path_qs
+    cached = _body_cache.get(key)
+    if cached and cached[0] == etag:
+        text = cached[1]
+    else:
+        text = dumps(build())
+        if len(_body_cache) >= BODY_CACHE_SIZE:
+            _body_cache.clear()
+        _body_cache[key] = (etag, text)
+    return web.Response(text=text, content_type='application/json',
+                        headers={'ETag': etag})
+
+
 async def ndjsonify(async_iterator, request):
     response = StreamResponse(status=200, reason='OK')
     response.headers['Content-Type'] = 'application/x-ndjson'
+    coding = negotiate_encoding(request)
+    compressor = None
+    if coding:
+        # Compressed by hand: aiohttp buffers compressed output until the
+        # end, this flushes each record so that live tails stay live
+        wbits = 16 + zlib.MAX_WBITS if coding == 'gzip' else zlib.MAX_WBITS
+        compressor = zlib.compressobj(wbits=wbits)
+        response.headers['Content-Encoding'] = coding
+        response.headers['Vary'] = 'Accept-Encoding'
     await response.prepare(request)
     async for element in async_iterator:
-        text = json_dumps(element) + '\n'
-        await response.write(text.encode('utf-8'))
+        data = (json_dumps(element) + '\n').encode('utf-8')
+        if compressor:
+            data = compressor.compress(data) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+        await response.write(data)
+    if compressor:
+        await response.write(compressor.flush())
     return response
 
 
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def current_umask():
+    # Can only be read by setting it; done once, before any thread runs
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+UMASK = current_umask()
+
+
+def write_atomic(path, text, durable=False):
+    path = Path(path)
+    fd, temp_name = tempfile.mkstemp(dir=str(path.parent),
+                                     prefix='.' + path.name + '.',
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            # mkstemp creates 0600 files, the file keeps its mode instead
+            try:
+                mode = os.stat(str(path)).st_mode & 0o7777
+            except FileNotFoundError:
+                mode = 0o666 & ~UMASK
+            os.fchmod(f.fileno(), mode)
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        os.replace(temp_name, str(path))
+    except BaseException:
+        try:
+            os.unlink(temp_name)
+        except FileNotFoundError:
+            pass
+        raise
+    if durable:
+        # Persist the rename itself
+        dir_fd = os.open(str(path.parent), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    # Identifies this very file, the rename keeps both
+    return st.st_mtime_ns, st.st_ino
+
+
+class PendingWrite:
+
+    def __init__(self, dump):
+        self.dump = dump
+        self.durable = False
+        self.waiters = []
+        self.handle = None
+
+
+class WriteBehind:
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        # path -> PendingWrite
+        self.pending = {}
+        # path -> future of the write in progress
+        self.writing = {}
+        # path -> (mtime_ns, inode) of the last file written here
+        self.written = {}
+
+    def record(self, path, stamp):
+        self.written[Path(path)] = stamp
+
+    def owns(self, path):
+        # Whether the file is, or is about to be, one written here; its
+        # content is then older than (or equal to) what is in memory
+        path = Path(path)
+        if path in self.pending or path in self.writing:
+            return True
+        try:
+            st = os.stat(str(path))
+        except FileNotFoundError:
+            return False
+        return self.written.get(path) == (st.st_mtime_ns, st.st_ino)
+
+    def schedule(self, path, dump, durable=False):
+        # Calls for the same path within `delay` seconds are coalesced into
+        # a single write of the latest dump(). The returned future resolves
+        # once it is on disk; durable writes skip the delay.
+        loop = asyncio.get_event_loop()
+        path = Path(path)
+        pending = self.pending.get(path)
+        if pending is None:
+            pending = self.pending[path] = PendingWrite(dump)
+        pending.dump = dump
+        waiter = loop.create_future()
+        pending.waiters.append(waiter)
+        if durable:
+            pending.durable = True
+        if pending.handle:
+            pending.handle.cancel()
+        delay = 0 if durable else self.delay
+        pending.handle = loop.call_later(
+            delay, lambda: asyncio.ensure_future(self._write(path)))
+        return waiter
+
+    async def _write(self, path):
+        # Writes to the same file never overlap
+        while path in self.writing:
+            try:
+                await asyncio.shield(self.writing[path])
+            except Exception:
+                # Already logged and reported to its own waiters
+                pass
+        pending = self.pending.pop(path, None)
+        if pending is None:
+            return
+        loop = asyncio.get_event_loop()
+        # Serialize on the loop so the snapshot is consistent
+        try:
+            text = pending.dump()
+            future = loop.run_in_executor(None, write_atomic, path, text,
+                                          pending.durable)
+            self.writing[path] = future
+            self.record(path, await future)
+        except Exception as e:
+            logger.exception("Cannot write '%s'", path)
+            for waiter in pending.waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+                    # Already logged, don't warn if nobody awaits it
+                    waiter.exception()
+        else:
+            logger.debug("Written '%s' (%d changes)", path,
+                         len(pending.waiters))
+            for waiter in pending.waiters:
+                if not waiter.done():
+                    waiter.set_result(path)
+        finally:
+            self.writing.pop(path, None)
+
+    async def flush(self):
+        for path in list(self.pending):
+            pending = self.pending.get(path)
+            if pending and pending.handle:
+                pending.handle.cancel()
+        await asyncio.gather(*(self._write(path)
+                               for path in list(self.pending)))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import re
+from email.utils import formatdate
+from pathlib import Path
+
+from aiohttp import web
+
+from venvui.utils.misc import negotiate_encoding
+
+logger = logging.getLogger(__name__)
+
+# Build tools put a content hash in the name of these files
+HASHED_NAME = re.compile(r'\.[0-9a-f]{8,}\.')
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json',
+                      'application/manifest+json', 'image/svg+xml',
+                      'image/x-icon', 'image/vnd.microsoft.icon')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+
+class Asset:
+
+    def __init__(self, path, data, immutable, min_compress_size):
+        self.content_type = (mimetypes.guess_type(str(path))[0] or
+                             'application/octet-stream')
+        self.data = data
+        self.etag = '"%s"' % hashlib.sha1(data).hexdigest()[:16]
+        self.mtime = int(path.stat().st_mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.cache_control = IMMUTABLE if immutable else REVALIDATE
+        self.gzipped = None
+        if len(data) >= min_compress_size and \
+                self.content_type.startswith(COMPRESSIBLE_TYPES):
+            gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(gzipped) < len(data):
+                self.gzipped = gzipped
+
+
+class StaticAssets:
+
+    def __init__(self, root, index='index.html', min_compress_size=512):
+        self.root = Path(root)
+        self.index = index
+        self.min_compress_size = min_compress_size
+        # relative path -> Asset
+        self.assets = {}
+        # Reading and compressing the tree happens in a worker thread,
+        # started by preload() so it does not delay binding the port
+        self.loaded = None
+
+    async def preload(self, app=None):
+        if self.loaded is None:
+            self.loaded = asyncio.get_event_loop().run_in_executor(
+                None, self.load)
+
+    def _manifest_paths(self):
+        try:
+            with open(self.root / 'asset-manifest.json') as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return set()
+        return {path.lstrip('/') for path in manifest.values()}
+
+    def load(self):
+        manifest = self._manifest_paths()
+        assets = {}
+        total = compressed = 0
+        for path in sorted(self.root.rglob('*')):
+            if not path.is_file() or path.suffix == '.gz':
+                continue
+            name = path.relative_to(self.root).as_posix()
+            immutable = name.startswith('static/') and (
+                name in manifest or bool(HASHED_NAME.search(path.name)))
+            asset = Asset(path, path.read_bytes(), immutable,
+                          self.min_compress_size)
+            # Prefer a precompressed file shipped next to the asset
+            precompressed = path.with_name(path.name + '.gz')
+            if precompressed.is_file():
+                asset.gzipped = precompressed.read_bytes()
+            assets[name] = asset
+            total += len(asset.data)
+            compressed += len(asset.gzipped or asset.data)
+        self.assets = assets
+        logger.info("Loaded %d static assets (%d bytes, %d compressed)",
+                    len(assets), total, compressed)
+
+    async def handle(self, request):
+        if self.loaded is None:
+            await self.preload()
+        await self.loaded
+        name = request.match_info.get('path') or self.index
+        asset = self.assets.get(name)
+        if asset is None:
+            raise web.HTTPNotFound()
+        headers = {'ETag': asset.etag,
+                   'Last-Modified': asset.last_modified,
+                   'Cache-Control': asset.cache_control,
+                   'Vary': 'Accept-Encoding'}
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            if asset.etag in (tag.strip() for tag in if_none_match.split(',')):
+                raise web.HTTPNotModified(headers=headers)
+        elif request.if_modified_since and \
+                request.if_modified_since.timestamp() >= asset.mtime:
+            raise web.HTTPNotModified(headers=headers)
+        body = asset.data
+        if asset.gzipped and negotiate_encoding(request) == 'gzip':
+            body = asset.gzipped
+            headers['Content-Encoding'] = 'gzip'
+        return web.Response(body=body, content_type=asset.content_type,
+                            headers=headers)
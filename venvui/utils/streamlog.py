@@ -1,18 +1,31 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import weakref
 from asyncio import Event
 from datetime import datetime
 
+from venvui.utils.metrics import Gauge
+
 logger = logging.getLogger(__name__)
 
+STREAMLOG_SUBSCRIBERS = Gauge(
+    'venvui_streamlog_subscribers', 'Active StreamLog readers')
+STREAMLOG_RECORDS = Gauge(
+    'venvui_streamlog_records', 'Records held by live StreamLogs')
+STREAMLOG_OPEN = Gauge(
+    'venvui_streamlog_open', 'StreamLogs still being written')
+
 
 class StreamLog:
+    instances = weakref.WeakSet()
 
     def __init__(self):
         self.stream = []
         self.written = Event()
         self.open = True
+        self.subscribers = 0
+        self.instances.add(self)
 
     def __aiter__(self):
         return self.retrieve()
@@ -27,6 +40,19 @@ class StreamLog:
         self.written.set()
         self.written.clear()
 
+    def put_many(self, records):
+        # One timestamp and one wakeup of the readers for the whole batch
+        if not self.open:
+            raise EOFError("StreamLog is closed")
+        if not records:
+            return
+        now = datetime.utcnow()
+        for record in records:
+            record.setdefault('time', now)
+        self.stream.extend(records)
+        self.written.set()
+        self.written.clear()
+
     def close(self):
         self.open = False
         self.written.set()
@@ -35,10 +61,22 @@ class StreamLog:
         return list(self.stream)
 
     async def retrieve(self):
-        for record in self.stream:
-            yield record
-        while self.open:
-            last = len(self.stream)
-            await self.written.wait()
-            for record in self.stream[last:]:
+        self.subscribers += 1
+        try:
+            for record in self.stream:
                 yield record
+            while self.open:
+                last = len(self.stream)
+                await self.written.wait()
+                for record in self.stream[last:]:
+                    yield record
+        finally:
+            self.subscribers -= 1
+
+
+STREAMLOG_SUBSCRIBERS.set_function(
+    lambda: sum(log.subscribers for log in list(StreamLog.instances)))
+STREAMLOG_RECORDS.set_function(
+    lambda: sum(len(log.stream) for log in list(StreamLog.instances)))
+STREAMLOG_OPEN.set_function(
+    lambda: sum(1 for log in list(StreamLog.instances) if log.open))
@@ -1,26 +1,261 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import time
 from asyncio import subprocess
+from pathlib import Path
+
+from venvui.utils.metrics import Counter, Gauge, Histogram
+
+SUBPROCESS_SPAWNED = Counter(
+    'venvui_subprocess_spawned_total',
+    'Subprocesses spawned, by command', ['command'])
+SUBPROCESS_DURATION = Histogram(
+    'venvui_subprocess_duration_seconds',
+    'Subprocess lifetime from spawn to exit, by command', ['command'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+             300, 600, 1800))
+
+SUBPROCESS_QUEUE_WAIT = Histogram(
+    'venvui_subprocess_queue_wait_seconds',
+    'Time waited for a subprocess slot, by pool', ['pool'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+             30, 60, 300))
+SUBPROCESS_REJECTED = Counter(
+    'venvui_subprocess_rejected_total',
+    'Subprocesses refused because their pool was saturated, by pool',
+    ['pool'])
+SUBPROCESS_RUNNING = Gauge(
+    'venvui_subprocess_running', 'Subprocess slots in use, by pool',
+    ['pool'])
+SUBPROCESS_QUEUED = Gauge(
+    'venvui_subprocess_queued', 'Subprocesses waiting for a slot, by pool',
+    ['pool'])
+
+
+class ExecutorSaturated(Exception):
+
+    def __init__(self, pool, retry_after):
+        super().__init__("Too many '%s' subprocesses, retry in %d s" %
+                         (pool, retry_after))
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class ProcessPool:
+
+    def __init__(self, name, size, queue_size=100, timeout=None):
+        self.name = name
+        self.size = size
+        # Work beyond size + queue_size, or a subprocess waiting longer than
+        # timeout, is refused instead of piling up
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(size)
+        # Admitted and not finished yet, whether it holds a slot or not
+        self.admitted = 0
+        self.running = 0
+        self.waiting = 0
+        # Moving average of how long slots are held, for Retry-After
+        self.hold_time = 1.0
+        self.queue_wait = SUBPROCESS_QUEUE_WAIT.labels(name)
+        self.rejected = SUBPROCESS_REJECTED.labels(name)
+        SUBPROCESS_RUNNING.labels(name).set_function(lambda: self.running)
+        SUBPROCESS_QUEUED.labels(name).set_function(lambda: self.waiting)
+
+    def retry_after(self):
+        return max(int(self.hold_time * (self.waiting + 1) / self.size + 1),
+                   1)
+
+    def check(self):
+        # Refuses early, before any work is done for the caller
+        if self.admitted >= self.size + self.queue_size:
+            self.rejected.inc()
+            raise ExecutorSaturated(self.name, self.retry_after())
+
+    def admit(self):
+        self.check()
+        self.admitted += 1
+        return Admission(self)
+
+    async def _wait(self, timeout):
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.rejected.inc()
+            raise ExecutorSaturated(self.name, self.retry_after())
+        finally:
+            self.waiting -= 1
+            self.queue_wait.observe(time.monotonic() - started)
+        self.running += 1
+        return time.monotonic()
+
+    def _release(self, acquired):
+        self.running -= 1
+        self.hold_time = (0.8 * self.hold_time +
+                          0.2 * (time.monotonic() - acquired))
+        self.semaphore.release()
+
+    async def acquire(self):
+        # A single subprocess, admitted on its own
+        self.check()
+        self.admitted += 1
+        try:
+            return await self._wait(self.timeout)
+        except BaseException:
+            self.admitted -= 1
+            raise
+
+    def release(self, acquired):
+        self._release(acquired)
+        self.admitted -= 1
+
+    def slot(self):
+        return PoolSlot(self)
+
+
+class Admission:
+    # Several subprocesses in a row (a deployment), admitted once: once in,
+    # they wait for their slots as long as it takes
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.closed = False
+
+    async def acquire(self):
+        return await self.pool._wait(None)
+
+    def release(self, acquired):
+        self.pool._release(acquired)
+
+    def slot(self):
+        return PoolSlot(self)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.admitted -= 1
+
+
+class PoolSlot:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.acquired = None
+
+    async def __aenter__(self):
+        self.acquired = await self.pool.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.pool.release(self.acquired)
+
+
+class SubprocessExecutor:
+
+    def __init__(self, pools=None):
+        # name -> (size, queue size, timeout)
+        settings = {
+            # systemctl and other quick commands
+            'control': (16, 200, 5),
+            # journalctl --follow, held as long as a client reads
+            'follow': (32, 0, 0.1),
+            # virtualenv, pip, compileall
+            'build': (4, 20, None),
+        }
+        settings.update(pools or {})
+        self.pools = {name: ProcessPool(name, *values)
+                      for name, values in settings.items()}
+
+    def __getitem__(self, name):
+        return self.pools[name]
+
+
+def command_label(command, shell=False):
+    return 'sh' if shell else Path(command[0]).name
+
+
+def track_process(label, process):
+    SUBPROCESS_SPAWNED.labels(label).inc()
+    histogram = SUBPROCESS_DURATION.labels(label)
+    started = time.monotonic()
+    asyncio.ensure_future(process.wait()).add_done_callback(
+        lambda f: histogram.observe(time.monotonic() - started))
+
+
+def split_lines(buffer, max_line):
+    # Complete lines of the buffer (newline included) and the unterminated
+    # rest; lines longer than max_line are cut in pieces of max_line
+    lines = []
+    end = buffer.rfind(b'\n') + 1
+    if end:
+        lines = [line + b'\n' for line in buffer[:end - 1].split(b'\n')]
+    rest = buffer[end:]
+    if max_line and (len(rest) > max_line or
+                     any(len(line) > max_line for line in lines)):
+        pieces = []
+        for line in lines:
+            pieces.extend(line[i:i + max_line]
+                          for i in range(0, len(line), max_line))
+        while len(rest) > max_line:
+            pieces.append(rest[:max_line])
+            rest = rest[max_line:]
+        lines = pieces
+    return lines, rest
 
 
 class SubProcessController:
-    def __init__(self, stdout_cb, stderr_cb):
+    def __init__(self, stdout_cb, stderr_cb, chunked=False,
+                 chunk_size=1 << 16, max_line=1 << 20, pool=None):
         self.stdout_cb = stdout_cb
         self.stderr_cb = stderr_cb
+        # A slot of the pool is held while the process runs
+        self.pool = pool
+        # In chunked mode, callbacks get lists of lines read in large
+        # blocks instead of one call per line
+        self.chunked = chunked
+        self.chunk_size = chunk_size
+        self.max_line = max_line
 
     async def _consume_stream(self, stream, callback):
         async for line in stream:
             if callback:
                 callback(line)
 
+    async def _consume_chunks(self, stream, callback):
+        rest = b''
+        while True:
+            chunk = await stream.read(self.chunk_size)
+            if not chunk:
+                break
+            lines, rest = split_lines(rest + chunk, self.max_line)
+            if lines and callback:
+                callback(lines)
+        if rest and callback:
+            callback([rest])
+
     async def start(self, *command, shell=False, **kw):
         pipe = subprocess.PIPE
         func = (asyncio.create_subprocess_shell
                 if shell else asyncio.create_subprocess_exec)
-        proc = await func(*command, stdin=None, stdout=pipe, stderr=pipe, **kw)
-        out = self._consume_stream(proc.stdout, self.stdout_cb)
-        err = self._consume_stream(proc.stderr, self.stderr_cb)
+        if self.pool:
+            acquired = await self.pool.acquire()
+        try:
+            proc = await func(*command, stdin=None, stdout=pipe, stderr=pipe,
+                              **kw)
+        except Exception:
+            if self.pool:
+                self.pool.release(acquired)
+            raise
+        if self.pool:
+            asyncio.ensure_future(proc.wait()).add_done_callback(
+                lambda f: self.pool.release(acquired))
+        track_process(command_label(command, shell), proc)
+        consume = (self._consume_chunks if self.chunked
+                   else self._consume_stream)
+        out = consume(proc.stdout, self.stdout_cb)
+        err = consume(proc.stderr, self.stderr_cb)
         asyncio.gather(out, err).add_done_callback(lambda f: f.result())
         return proc
 
@@ -1,16 +1,86 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+
 from aiohttp import web
 from aiohttp.web_response import StreamResponse
 
+from venvui.services.profiler import ProfilerBusy
+from venvui.services.project import Project, RollbackError
+from venvui.utils.metrics import REGISTRY
 from venvui.utils.misc import jsonify, jsonbody, ndjsonify, json_dumps
+from venvui.utils.misc import cached_jsonify, make_etag
+from venvui.utils.subproc import ExecutorSaturated
+
+PACKAGE_FIELDS = ('type', 'path', 'size', 'modified', 'filename',
+                  'metadata', 'error')
+DEPLOYMENT_FIELDS = ('key', 'project_key', 'venv_name', 'package_filename',
+                     'state', 'created_at', 'started_at', 'stopped_at',
+                     'elapsed', 'phases')
+SERVICE_FIELDS = ('name', 'project_key', 'startup', 'error', 'status')
+
+
+def requested_fields(request, allowed):
+    fields = request.query.get('fields')
+    if not fields:
+        return None
+    fields = tuple(field.strip() for field in fields.split(',')
+                   if field.strip())
+    unknown = set(fields) - set(allowed)
+    if unknown:
+        raise web.HTTPBadRequest(
+            reason="Unknown fields: %s" % ', '.join(sorted(unknown)))
+    return fields
+
+
+def positive_int(request, name, default):
+    value = request.query.get(name, default)
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise web.HTTPBadRequest(
+            reason="'%s' must be a positive integer" % name)
+    return value
+
+
+def select_fields(obj, fields):
+    if fields is None:
+        return obj
+    return {field: obj.get(field) for field in fields}
+
+
+async def get_readiness(request):
+    project_svc = request.app['projects']
+
+    readiness = project_svc.readiness()
+    if not readiness['ready']:
+        raise web.HTTPServiceUnavailable(reason="Loading projects")
+    return jsonify(readiness)
+
+
+async def get_metrics(request):
+    text = REGISTRY.render()
+    return web.Response(body=text.encode('utf-8'), headers={
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
 
 async def list_projects(request):
     project_svc = request.app['projects']
+    systemd_svc = request.app['systemd']
+    deployment_svc = request.app['deployments']
+    fields = requested_fields(request, Project.summary_fields)
+    etag = make_etag(project_svc.version, systemd_svc.version,
+                     deployment_svc.version)
+    if deployment_svc.running():
+        etag = None
 
-    projects = project_svc.list_projects()
-    return jsonify(projects=[p.summary(with_services=True) for p in projects])
+    def build():
+        projects = project_svc.list_projects()
+        return dict(projects=[p.summary(with_services=True, fields=fields)
+                              for p in projects])
+    return cached_jsonify(request, etag, build)
 
 
 async def create_project(request):
@@ -28,24 +98,46 @@ async def get_project(request):
     project = project_svc.get_project(name)
     if not project:
         raise web.HTTPNotFound(reason="Project not found")
+    systemd_svc = request.app['systemd']
+    deployment_svc = request.app['deployments']
+    fields = requested_fields(request, Project.summary_fields)
+    etag = make_etag(project_svc.version, systemd_svc.version,
+                     deployment_svc.version)
+    if deployment_svc.running(project.key):
+        etag = None
 
-    return jsonify(project.summary(with_services=True))
+    return cached_jsonify(request, etag, lambda: project.summary(
+        with_services=True, fields=fields))
 
 
 async def list_packages(request):
     package_svc = request.app['packages']
+    fields = requested_fields(request, PACKAGE_FIELDS)
+    with_metadata = fields is None or bool({'metadata', 'error'} & set(fields))
+    etag = make_etag(package_svc.version, package_svc.root_mtime())
 
-    packages = package_svc.list_packages()
-    return jsonify(packages=list(packages))
+    def build():
+        packages = package_svc.list_packages(with_metadata=with_metadata)
+        return dict(packages=[select_fields(package, fields)
+                              for package in packages])
+    return cached_jsonify(request, etag, build)
 
 
 async def get_package(request):
     package_svc = request.app['packages']
     filename = request.match_info['filename']
-    package = package_svc.get_package(filename)
-    if not package:
+    st = package_svc.package_stat(filename)
+    if st is None:
         raise web.HTTPNotFound(reason="Package not found")
-    return jsonify(package)
+
+    def build():
+        package = package_svc.get_package(filename)
+        if not package:
+            raise web.HTTPNotFound(reason="Package not found")
+        return package
+
+    etag = make_etag(st.st_size, st.st_mtime_ns)
+    return cached_jsonify(request, etag, build)
 
 
 async def upload_package(request):
@@ -74,18 +166,47 @@ async def start_deployment(request):
 
 async def list_deployments(request):
     deployment_svc = request.app['deployments']
+    fields = requested_fields(request, DEPLOYMENT_FIELDS)
+    etag = make_etag(deployment_svc.version)
+    if deployment_svc.running():
+        etag = None
 
-    deployments = [v.to_dict() for v in deployment_svc.list_deployments()]
-    return jsonify(deployments=deployments)
+    def build():
+        return dict(deployments=[select_fields(v.to_dict(), fields) for v
+                                 in deployment_svc.list_deployments()])
+    return cached_jsonify(request, etag, build)
 
 
 async def list_project_deployments(request):
     deployment_svc = request.app['deployments']
     project_name = request.match_info['key']
+    fields = requested_fields(request, DEPLOYMENT_FIELDS)
+    etag = make_etag(deployment_svc.version)
+    if deployment_svc.running(project_name):
+        etag = None
+
+    def build():
+        deployment_list = deployment_svc.list_deployments(project_name)
+        return dict(deployments=[select_fields(v.to_dict(), fields)
+                                 for v in deployment_list])
+    return cached_jsonify(request, etag, build)
+
+
+async def get_deployment_stats(request):
+    deployment_svc = request.app['deployments']
+    last = positive_int(request, 'last', 20)
+
+    stats = deployment_svc.phase_stats(last=last)
+    return jsonify(projects=stats)
+
+
+async def get_project_deployment_stats(request):
+    deployment_svc = request.app['deployments']
+    project_name = request.match_info['key']
+    last = positive_int(request, 'last', 20)
 
-    deployment_list = deployment_svc.list_deployments(project_name)
-    deployments = [v.to_dict() for v in deployment_list]
-    return jsonify(deployments=deployments)
+    stats = deployment_svc.phase_stats(by_project_key=project_name, last=last)
+    return jsonify(stats.get(project_name, {'deployments': 0, 'phases': {}}))
 
 
 async def get_deployment(request):
@@ -93,8 +214,24 @@ async def get_deployment(request):
     key = request.match_info['key']
 
     deployment = deployment_svc.get_deployment(key)
+    etag = make_etag(deployment_svc.version)
+    if deployment.started_at and not deployment.stopped_at:
+        etag = None
 
-    return jsonify(deployment.to_dict())
+    return cached_jsonify(request, etag, deployment.to_dict)
+
+
+async def get_deployment_packages(request):
+    deployment_svc = request.app['deployments']
+    inventory_svc = request.app['inventory']
+    key = request.match_info['key']
+
+    deployment = deployment_svc.get_deployment(key)
+    try:
+        packages = await inventory_svc.list_packages(deployment.venv_path)
+    except FileNotFoundError as e:
+        raise web.HTTPNotFound(reason=str(e))
+    return jsonify(venv=deployment.venv_name, packages=packages)
 
 
 async def get_deployment_log(request):
@@ -106,6 +243,154 @@ async def get_deployment_log(request):
     return response
 
 
+def get_venv_path(project, venv_name):
+    venv_path = project.get_venv_path(venv_name)
+    if venv_path is None:
+        raise web.HTTPNotFound(reason="Venv not found")
+    return venv_path
+
+
+async def list_project_venvs(request):
+    project_svc = request.app['projects']
+    name = request.match_info['key']
+    project = project_svc.get_project(name)
+    if not project:
+        raise web.HTTPNotFound(reason="Project not found")
+
+    collector = request.app['collector']
+    return jsonify(current=project.current_venv(),
+                   policy=collector.policy(project),
+                   usage=collector.project_usage(project),
+                   venvs=collector.plan(project))
+
+
+async def collect_project_venvs(request):
+    project_svc = request.app['projects']
+    collector = request.app['collector']
+    name = request.match_info['key']
+    project = project_svc.get_project(name)
+    if not project:
+        raise web.HTTPNotFound(reason="Project not found")
+
+    dry_run = 'dry_run' in request.query
+    plan = collector.collect(project, dry_run=dry_run)
+    return jsonify(dry_run=dry_run,
+                   removed=[venv['name'] for venv in plan
+                            if not venv['keep']],
+                   venvs=plan)
+
+
+async def get_retention(request):
+    project_svc = request.app['projects']
+    collector = request.app['collector']
+    name = request.match_info['key']
+    project = project_svc.get_project(name)
+    if not project:
+        raise web.HTTPNotFound(reason="Project not found")
+    return jsonify(collector.policy(project))
+
+
+async def set_retention(request):
+    project_svc = request.app['projects']
+    collector = request.app['collector']
+    name = request.match_info['key']
+    project = project_svc.get_project(name)
+    if not project:
+        raise web.HTTPNotFound(reason="Project not found")
+
+    data = await jsonbody(request)
+    try:
+        saved = project.set_retention(
+            data, durable='durable' in request.query)
+    except ValueError as e:
+        raise web.HTTPBadRequest(reason=str(e))
+    if 'durable' in request.query:
+        await saved
+    return jsonify(collector.policy(project))
+
+
+async def get_venvs_usage(request):
+    project_svc = request.app['projects']
+    collector = request.app['collector']
+
+    projects = {project.key: collector.project_usage(project)
+                for project in project_svc.list_projects()}
+    return jsonify(projects=projects,
+                   size=sum(usage['size'] for usage in projects.values()),
+                   deleting=len(collector.trash))
+
+
+async def get_venv_packages(request):
+    project_svc = request.app['projects']
+    inventory_svc = request.app['inventory']
+    name = request.match_info['key']
+    project = project_svc.get_project(name)
+    if not project:
+        raise web.HTTPNotFound(reason="Project not found")
+    venv_path = get_venv_path(project, request.match_info['venv'])
+
+    try:
+        packages = await inventory_svc.list_packages(venv_path)
+    except FileNotFoundError as e:
+        raise web.HTTPNotFound(reason=str(e))
+    return jsonify(venv=venv_path.name, packages=packages)
+
+
+async def get_venv_diff(request):
+    project_svc = request.app['projects']
+    inventory_svc = request.app['inventory']
+    name = request.match_info['key']
+    project = project_svc.get_project(name)
+    other_project = project_svc.get_project(request.query.get('project',
+                                                              name))
+    if not project or not other_project:
+        raise web.HTTPNotFound(reason="Project not found")
+    venv_path = get_venv_path(project, request.match_info['venv'])
+    other_path = get_venv_path(other_project, request.match_info['other'])
+
+    try:
+        diff = await inventory_svc.diff(venv_path, other_path)
+    except FileNotFoundError as e:
+        raise web.HTTPNotFound(reason=str(e))
+    return jsonify(venv=venv_path.name, other=other_path.name, **diff)
+
+
+async def dedup_venv(request):
+    project_svc = request.app['projects']
+    dedup_svc = request.app['dedup']
+    name = request.match_info['key']
+    project = project_svc.get_project(name)
+    if not project:
+        raise web.HTTPNotFound(reason="Project not found")
+    venv_path = get_venv_path(project, request.match_info['venv'])
+
+    stats = await dedup_svc.dedup(venv_path)
+    return jsonify(venv=venv_path.name, **stats)
+
+
+async def rollback_project(request):
+    project_svc = request.app['projects']
+    name = request.match_info['key']
+    project = project_svc.get_project(name)
+    if not project:
+        raise web.HTTPNotFound(reason="Project not found")
+
+    data = await jsonbody(request) if request.can_read_body else {}
+    venv_name = data.get('venv')
+    if venv_name is not None and not isinstance(venv_name, str):
+        raise web.HTTPBadRequest(reason="'venv' must be a string")
+    timeout = data.get('timeout', 30)
+    if not isinstance(timeout, (int, float)) or isinstance(timeout, bool) \
+            or not timeout > 0:
+        raise web.HTTPBadRequest(reason="'timeout' must be a positive number")
+    try:
+        result = await project.rollback(venv_name=venv_name,
+                                        timeout=timeout)
+    except RollbackError as e:
+        raise web.HTTPConflict(reason=str(e))
+    return jsonify(result)
+
+
 async def get_config_files(request):
     project_svc = request.app['projects']
     name = request.match_info['key']
@@ -138,8 +423,11 @@ async def add_config_file(request):
         raise web.HTTPNotFound(reason="Project not found")
 
     data = await jsonbody(request)
-    project.add_config_file(data['name'], data['template'], data['path'],
-                            data['variables'])
+    saved = project.add_config_file(data['name'], data['template'],
+                                    data['path'], data['variables'],
+                                    durable='durable' in request.query)
+    if 'durable' in request.query:
+        await saved
     config = project.get_config_file(data['name'])
     return jsonify(config)
 
@@ -154,7 +442,10 @@ async def change_config_file(request):
     if not project.has_config_file(config_name):
         raise web.HTTPNotFound(reason="Config file not found")
     data = await jsonbody(request)
-    project.change_config_file(config_name, data)
+    saved = project.change_config_file(
+        config_name, data, durable='durable' in request.query)
+    if 'durable' in request.query:
+        await saved
     if 'name' in data:
         config_name = data['name']
     config = project.get_config_file(config_name)
@@ -170,7 +461,10 @@ async def remove_config_file(request):
         raise web.HTTPNotFound(reason="Project not found")
     if not project.has_config_file(config_name):
         raise web.HTTPNotFound(reason="Config file not found")
-    project.remove_config_file(config_name)
+    saved = project.remove_config_file(
+        config_name, durable='durable' in request.query)
+    if 'durable' in request.query:
+        await saved
     return web.HTTPNoContent()
 
 
@@ -182,10 +476,25 @@ async def install_config_file(request):
     if not project:
         raise web.HTTPNotFound(reason="Project not found")
 
-    config = project.install_config_file(config_name)
+    dry_run = 'dry_run' in request.query
+    config = project.install_config_file(config_name, dry_run=dry_run)
     return jsonify(config)
 
 
+async def install_config_files(request):
+    project_svc = request.app['projects']
+    data = await jsonbody(request)
+    project_key = data.get('project')
+    if project_key and not project_svc.get_project(project_key):
+        raise web.HTTPNotFound(reason="Project not found")
+
+    results = project_svc.install_config_files(
+        project_key=project_key, template=data.get('template'),
+        dry_run=data.get('dry_run', False))
+    response = await ndjsonify(results, request)
+    return response
+
+
 async def get_project_services(request):
     project_svc = request.app['projects']
     name = request.match_info['key']
@@ -232,7 +541,10 @@ async def add_service(request):
     if not project:
         raise web.HTTPNotFound(reason="Project not found")
     data = await jsonbody(request)
-    project.add_systemd_service(data['service'])
+    saved = project.add_systemd_service(
+        data['service'], durable='durable' in request.query)
+    if 'durable' in request.query:
+        await saved
     return web.HTTPNoContent()
 
 
@@ -244,14 +556,22 @@ async def delete_service(request):
     if not project:
         raise web.HTTPNotFound(reason="Project not found")
 
-    project.remove_systemd_service(service)
+    saved = project.remove_systemd_service(
+        service, durable='durable' in request.query)
+    if 'durable' in request.query:
+        await saved
     return web.HTTPNoContent()
 
 
 async def list_services(request):
     systemd_svc = request.app['systemd']
-    services = systemd_svc.list_services()
-    return jsonify(services=services)
+    fields = requested_fields(request, SERVICE_FIELDS)
+    etag = make_etag(systemd_svc.version)
+
+    def build():
+        return dict(services=[select_fields(service, fields) for service
+                              in systemd_svc.list_services()])
+    return cached_jsonify(request, etag, build)
 
 
 async def get_service(request):
@@ -271,3 +591,114 @@ async def get_service_log(request):
     async_gen = systemd_svc.get_log(service, lines=20)
     response = await ndjsonify(async_gen, request)
     return response
+
+
+async def get_service_resources(request):
+    systemd_svc = request.app['systemd']
+    service = request.match_info['service']
+
+    samples = systemd_svc.get_resources(service)
+    return jsonify(name=service, samples=samples)
+
+
+async def get_loop_report(request):
+    loop_monitor = request.app['loop_monitor']
+    limit = positive_int(request, 'limit', 10)
+
+    return jsonify(loop_monitor.report(limit=limit))
+
+
+def profile_response(data, filename, content_type='text/plain'):
+    return web.Response(body=data, content_type=content_type, headers={
+        'Content-Disposition': 'attachment; filename="%s"' % filename})
+
+
+async def profile_cpu(request):
+    profiler = request.app['profiler']
+    mode = request.query.get('mode', 'cprofile')
+    try:
+        seconds = float(request.query.get('seconds', 10))
+        if mode == 'sampling':
+            data = await profiler.profile_sampling(seconds)
+            return profile_response(data, 'venvui-cpu.collapsed')
+        elif mode == 'cprofile':
+            output = request.query.get('format', 'pstats')
+            data = await profiler.profile_cpu(seconds, output=output)
+            if output == 'pstats':
+                return profile_response(data, 'venvui-cpu.pstats',
+                                        'application/octet-stream')
+            return profile_response(data, 'venvui-cpu.txt')
+    except ProfilerBusy as e:
+        raise web.HTTPConflict(reason=str(e))
+    except ValueError as e:
+        raise web.HTTPBadRequest(reason=str(e))
+    raise web.HTTPBadRequest(reason="Unknown mode")
+
+
+async def profile_memory(request):
+    profiler = request.app['profiler']
+    try:
+        seconds = float(request.query.get('seconds', 10))
+        data = await profiler.profile_memory(seconds)
+    except ProfilerBusy as e:
+        raise web.HTTPConflict(reason=str(e))
+    except ValueError as e:
+        raise web.HTTPBadRequest(reason=str(e))
+    return profile_response(data, 'venvui-memory.txt')
+
+
+async def batch_request(request, base, prefix, item):
+    path = item.get('path', '')
+    headers = base.headers.copy()
+    # Sub-requests are always answered in full
+    headers.popall('If-None-Match', None)
+    sub_request = base.clone(method='GET', rel_url=prefix + path,
+                             headers=headers)
+    match_info = await request.app.router.resolve(sub_request)
+    if match_info.http_exception:
+        return 404, None, "Not found"
+    if match_info.handler not in BATCH_VIEWS:
+        return 400, None, "Not allowed in a batch"
+    match_info.add_app(request.app)
+    match_info.freeze()
+    sub_request._match_info = match_info
+    try:
+        response = await match_info.handler(sub_request)
+    except web.HTTPException as ex:
+        return ex.status, None, ex.reason
+    except ExecutorSaturated as e:
+        return 503, None, str(e)
+    except Exception as e:
+        return 500, None, '%s: %s' % (e.__class__.__name__, e)
+    return response.status, response.text, None
+
+
+async def batch(request):
+    # Requests can't be cloned once their body is read
+    base = request.clone()
+    data = await jsonbody(request)
+    items = data.get('requests', [])
+    prefix = request.path[:-len('/batch')]
+    results = await asyncio.gather(*(batch_request(request, base, prefix,
+                                                   item)
+                                     for item in items))
+    # Bodies are already serialized, so they are spliced in as they are
+    parts = []
+    for item, (status, body, error) in zip(items, results):
+        parts.append('{"id": %s, "status": %d, "body": %s, "error": %s}' % (
+            json_dumps(item.get('id')), status, body or 'null',
+            json_dumps(error)))
+    text = '{"responses": [%s]}' % ', '.join(parts)
+    return web.Response(text=text, content_type='application/json')
+
+
+# Read-only views that return plain JSON, safe to run inside a batch
+BATCH_VIEWS = {
+    list_projects, get_project, list_project_deployments, get_config_files,
+    get_config_file, get_project_services, get_project_service,
+    list_packages, get_package, list_deployments, get_deployment,
+    get_deployment_stats, get_project_deployment_stats, list_services,
+    get_service, get_service_resources, get_readiness, list_project_venvs,
+    get_venv_packages, get_venv_diff, get_deployment_packages, get_retention,
+    get_venvs_usage,
+}
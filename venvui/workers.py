@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+# Multi-worker mode: the supervisor process owns all state (projects,
+# deployments, systemd polling) and serves the API on a Unix socket only.
+# N worker processes share the HTTP port through SO_REUSEPORT; they answer
+# the hot read endpoints from a snapshot the supervisor publishes, serve the
+# frontend, and forward everything else (writes, log streams, systemctl
+# status) to the supervisor.
+#
+# Request metrics (/api/metrics) are those of the supervisor: they cover the
+# requests forwarded to it, not the reads the workers answer themselves.
+#
+#   venvui -c venvui.toml --workers 4
+
+import argparse
+import asyncio
+import json
+import logging
+import logging.config
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import hdrs, web
+
+from venvui.utils.metrics import Counter, Histogram
+from venvui.utils.misc import check_etag, json_error
+from venvui.utils.static import StaticAssets
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PUBLISHED = Counter(
+    'venvui_snapshot_published_total', 'Snapshots published to the workers')
+SNAPSHOT_DURATION = Histogram(
+    'venvui_snapshot_duration_seconds', 'Time spent publishing a snapshot',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+here_path = Path(__file__).parent
+
+# Read endpoints served by the workers; anything else, including these with
+# a query string, goes to the supervisor
+SNAPSHOT_PATHS = ('/api/projects', '/api/services', '/api/deployments',
+                  '/api/deployments/stats', '/api/packages')
+PROJECT_PATH = '/api/projects/%s'
+
+# Marks the publisher's own requests, left out of the request metrics
+SNAPSHOT_HEADER = 'X-Venvui-Snapshot'
+
+# Not forwarded as they are, in either direction
+HOP_BY_HOP = {hdrs.CONNECTION, hdrs.KEEP_ALIVE, hdrs.TRANSFER_ENCODING,
+              hdrs.CONTENT_LENGTH, hdrs.HOST, hdrs.UPGRADE, hdrs.TE,
+              hdrs.TRAILER, hdrs.PROXY_AUTHENTICATE, hdrs.PROXY_AUTHORIZATION}
+
+
+def supervisor_paths(config):
+    # Derived the same way by the supervisor and every worker
+    temp_path = Path(config['temp_path'])
+    return (Path(config.get('supervisor_socket', temp_path / 'venvui.sock')),
+            Path(config.get('snapshot_path',
+                            temp_path / 'venvui-snapshot.json')))
+
+
+def write_snapshot(path, snapshot):
+    # Replaced atomically, workers never read a partial file
+    temp = path.with_name('.%s.%d' % (path.name, os.getpid()))
+    with temp.open('w') as f:
+        json.dump(snapshot, f)
+    os.replace(str(temp), str(path))
+
+
+def remove_snapshot(path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class SnapshotPublisher:
+
+    def __init__(self, project_svc, systemd_svc, deployment_svc, package_svc,
+                 socket_path, snapshot_path, interval=0.5,
+                 refresh_timeout=5):
+        self.project_svc = project_svc
+        self.systemd_svc = systemd_svc
+        self.deployment_svc = deployment_svc
+        self.package_svc = package_svc
+        self.socket_path = socket_path
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        # How long a write waits for the snapshot that includes it
+        self.refresh_timeout = refresh_timeout
+        self.published_versions = None
+        self.wakeup = asyncio.Event()
+        self.waiters = []
+        task = asyncio.ensure_future(self.run())
+        task.add_done_callback(lambda f: f.result())
+
+    def versions(self):
+        # Every snapshot body carries an ETag built from these
+        return (self.project_svc.version, self.systemd_svc.version,
+                self.deployment_svc.version, self.package_svc.version,
+                self.package_svc.root_mtime())
+
+    def paths(self):
+        return SNAPSHOT_PATHS + tuple(
+            PROJECT_PATH % project.key
+            for project in self.project_svc.list_projects())
+
+    async def run(self):
+        await self.project_svc.loaded.wait()
+        connector = aiohttp.UnixConnector(path=str(self.socket_path))
+        async with aiohttp.ClientSession(connector=connector) as session:
+            while True:
+                self.wakeup.clear()
+                # Only writes finished before this point are waited for
+                waiters, self.waiters = self.waiters, []
+                versions = self.versions()
+                if waiters or versions != self.published_versions:
+                    try:
+                        await self.publish(session)
+                        self.published_versions = versions
+                    except (OSError, aiohttp.ClientError):
+                        logger.warning("Cannot publish snapshot",
+                                       exc_info=True)
+                        if not await self.withdraw():
+                            # Retried with the next round, unless the
+                            # write stopped waiting
+                            self.waiters.extend(waiter for waiter in waiters
+                                                if not waiter.done())
+                            waiters = []
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def publish(self, session):
+        # Rendered through the supervisor's own API, so bodies and ETags are
+        # exactly what it would answer
+        started = time.monotonic()
+        entries = await asyncio.gather(*(self.fetch(session, path)
+                                         for path in self.paths()))
+        entries = {path: entry for path, entry in entries if entry}
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, write_snapshot, self.snapshot_path,
+                                   {'published': time.time(),
+                                    'entries': entries})
+        SNAPSHOT_PUBLISHED.inc()
+        SNAPSHOT_DURATION.observe(time.monotonic() - started)
+
+    @staticmethod
+    async def fetch(session, path):
+        async with session.get('http://supervisor' + path, headers={
+                hdrs.ACCEPT_ENCODING: 'identity',
+                SNAPSHOT_HEADER: '1'}) as response:
+            etag = response.headers.get(hdrs.ETAG)
+            # Without an etag the body is live (running deployments), it
+            # is left to the supervisor
+            if response.status != 200 or etag is None:
+                return path, None
+            return path, {'etag': etag, 'body': await response.text()}
+
+    async def withdraw(self):
+        # Without a snapshot workers forward every read, so a failed
+        # publish costs throughput, never consistency
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, remove_snapshot,
+                                       self.snapshot_path)
+        except OSError:
+            logger.exception("Cannot remove snapshot '%s'",
+                             self.snapshot_path)
+            return False
+        self.published_versions = None
+        return True
+
+    async def refresh(self):
+        # Waits for a snapshot that includes every change made so far
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        self.wakeup.set()
+        await waiter
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        # A client reading right after a write may hit any worker
+        response = await handler(request)
+        if request.method not in (hdrs.METH_GET, hdrs.METH_HEAD,
+                                  hdrs.METH_OPTIONS) and \
+                response is not None and response.status < 400:
+            try:
+                await asyncio.wait_for(self.refresh(), self.refresh_timeout)
+            except asyncio.TimeoutError:
+                # Workers may answer stale reads until a publish succeeds
+                logger.error("No snapshot published within %s s after %s %s",
+                             self.refresh_timeout, request.method,
+                             request.path)
+        return response
+
+
+class WorkerManager:
+
+    def __init__(self, config_path, workers, restart_delay=1):
+        self.config_path = str(config_path)
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.processes = {}
+        self.stopping = False
+
+    async def start(self, app=None):
+        for number in range(self.workers):
+            task = asyncio.ensure_future(self._keep_running(number))
+            task.add_done_callback(lambda f: f.result())
+
+    async def _keep_running(self, number):
+        while not self.stopping:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'venvui.workers', '-c',
+                self.config_path)
+            self.processes[number] = process
+            logger.info("Started worker %d (pid %d)", number, process.pid)
+            code = await process.wait()
+            del self.processes[number]
+            if not self.stopping:
+                logger.error("Worker %d exited with %s, restarting",
+                             number, code)
+                await asyncio.sleep(self.restart_delay)
+
+    async def stop(self, app=None):
+        self.stopping = True
+        for process in self.processes.values():
+            process.terminate()
+        await asyncio.gather(*(process.wait()
+                               for process in self.processes.values()))
+
+
+class Snapshot:
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.entries = {}
+
+    def get(self, path):
+        # One stat per request: a snapshot published after a write is
+        # seen by the very next read
+        try:
+            st = os.stat(str(self.path))
+        except FileNotFoundError:
+            return None
+        if (st.st_mtime_ns, st.st_ino) != self.stamp:
+            with self.path.open() as f:
+                self.entries = json.load(f)['entries']
+            self.stamp = (st.st_mtime_ns, st.st_ino)
+        return self.entries.get(path)
+
+
+class Worker:
+
+    def __init__(self, socket_path, snapshot_path):
+        self.socket_path = socket_path
+        self.snapshot = Snapshot(snapshot_path)
+        self.session = None
+
+    async def start(self, app=None):
+        connector = aiohttp.UnixConnector(path=str(self.socket_path))
+        # Log streams last as long as the client reads; bodies are passed
+        # through as they are, compressed or not
+        self.session = aiohttp.ClientSession(
+            connector=connector, auto_decompress=False,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=5))
+        task = asyncio.ensure_future(self.watch_supervisor(os.getppid()))
+        task.add_done_callback(lambda f: f.result())
+
+    async def watch_supervisor(self, supervisor_pid, interval=1):
+        # A killed supervisor can't stop its workers, they stop themselves
+        while os.getppid() == supervisor_pid:
+            await asyncio.sleep(interval)
+        logger.error("Supervisor %d is gone, stopping", supervisor_pid)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    async def stop(self, app=None):
+        await self.session.close()
+
+    async def handle(self, request):
+        # Cross-origin reads get their CORS headers from the supervisor
+        if request.method == hdrs.METH_GET and not request.query_string and \
+                hdrs.ORIGIN not in request.headers:
+            entry = self.snapshot.get(request.path)
+            if entry:
+                check_etag(request, entry['etag'])
+                return web.Response(text=entry['body'],
+                                    content_type='application/json',
+                                    headers={hdrs.ETAG: entry['etag']})
+        return await self.forward(request)
+
+    async def forward(self, request):
+        headers = {name: value for name, value in request.headers.items()
+                   if name not in HOP_BY_HOP and name != SNAPSHOT_HEADER}
+        headers[hdrs.X_FORWARDED_FOR] = request.remote or ''
+        body = request.content if request.body_exists else None
+        try:
+            upstream = await self.session.request(
+                request.method, 'http://supervisor' + request.path_qs,
+                headers=headers, data=body, allow_redirects=False)
+        except aiohttp.ClientConnectionError:
+            response = json_error("Supervisor unavailable", 503)
+            response.headers[hdrs.RETRY_AFTER] = '1'
+            return response
+        try:
+            response = web.StreamResponse(status=upstream.status,
+                                          reason=upstream.reason)
+            for name, value in upstream.headers.items():
+                if name not in HOP_BY_HOP:
+                    response.headers.add(name, value)
+            if upstream.content_length is not None:
+                response.content_length = upstream.content_length
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_any():
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            upstream.release()
+
+
+def worker_app(config):
+    # Imported here: the supervisor imports this module, not the reverse
+    from venvui.app import compression_middleware
+
+    socket_path, snapshot_path = supervisor_paths(config)
+    worker = Worker(socket_path, snapshot_path)
+    frontend = StaticAssets(here_path / 'frontend')
+
+    app = web.Application(middlewares=[compression_middleware])
+    app['config'] = config
+    app.on_startup.append(worker.start)
+    app.on_startup.append(frontend.preload)
+    app.on_cleanup.append(worker.stop)
+    app.router.add_route('*', '/api', worker.handle)
+    app.router.add_route('*', '/api/{path:.*}', worker.handle)
+    app.router.add_get('/', frontend.handle)
+    app.router.add_get('/{path:.+}', frontend.handle)
+    return app
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='VENVUI HTTP worker, started by the supervisor.')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Configuration file')
+    args = parser.parse_args(args)
+
+    from venvui.app import load_config
+    config = load_config(args.config)
+    logging.config.dictConfig(config['logging'])
+    logging.captureWarnings(True)
+
+    web.run_app(worker_app(config), host=config['http_host'],
+                port=config['http_port'], reuse_port=True,
+                print=None)
+
+
+if __name__ == '__main__':
+    main()